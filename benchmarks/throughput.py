@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark of o365creeper against the local mock server.
+#
+# Every scenario starts a fresh mock server (o365creeper.mockserver) with its
+# own latency, throttling and error settings, runs the CLI over a generated
+# address list and reports throughput, latency percentiles (from --metrics)
+# and the CPU time and peak RSS of the client process.
+#
+#   python benchmarks/throughput.py                      # default scenarios
+#   python benchmarks/throughput.py -s 1m-w200           # a single scenario
+#   python benchmarks/throughput.py --save base.json     # keep the results
+#   python benchmarks/throughput.py --baseline base.json # flag regressions
+#   python benchmarks/throughput.py -- --uvloop          # extra client options
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+
+
+@dataclass
+class Scenario:
+    addresses: int
+    client: List[str]
+    mock: List[str] = field(default_factory=list)
+    # only run when asked for by name
+    large: bool = False
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "10k-w20": Scenario(10_000, ["-w", "20"]),
+    "10k-w100": Scenario(10_000, ["-w", "100"]),
+    "100k-w100": Scenario(100_000, ["-w", "100"]),
+    "100k-w200-sessions4": Scenario(100_000, ["-w", "200", "--sessions", "4"]),
+    "100k-w100-throttle": Scenario(100_000, ["-w", "100"], ["--throttle", "0.02"]),
+    "100k-w200-adaptive": Scenario(
+        100_000, ["-w", "200", "--adaptive"], ["--throttle-above", "80"]
+    ),
+    "100k-w100-errors": Scenario(
+        100_000,
+        ["-w", "100"],
+        ["--error-rate", "0.01", "--rate-limit-rate", "0.01", "--drop-rate", "0.01"],
+    ),
+    "1m-w200": Scenario(1_000_000, ["-w", "200"], large=True),
+}
+
+# metrics compared with --baseline, and whether higher is better
+COMPARED = {
+    "throughput": True,
+    "cpu_us": False,
+    "p99_ms": False,
+    "peak_rss_mb": False,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def address_file(directory: Path, count: int) -> Path:
+    # 1% valid addresses spread over 50 domains
+    path = directory / f"addresses-{count}.txt"
+    if not path.exists():
+        with open(path, "w") as f:
+            for i in range(count):
+                local = f"valid{i}" if i % 100 == 0 else f"user{i}"
+                f.write(f"{local}@bench{i % 50}.example\n")
+    return path
+
+
+def wait_for(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stats"):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("mock server did not start")
+
+
+def run_client(args: List[str], env: Dict) -> Tuple[float, int, float, int]:
+    """Run the CLI, return wall time, exit status, CPU time and peak RSS in KiB."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "o365creeper.cli", *args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    cpu = usage.ru_utime + usage.ru_stime
+    return time.perf_counter() - start, proc.returncode, cpu, usage.ru_maxrss
+
+
+def run_scenario(
+    name: str,
+    scenario: Scenario,
+    workdir: Path,
+    latency: float,
+    env: Dict,
+    extra: List[str],
+) -> Dict:
+    addresses = address_file(workdir, scenario.addresses)
+    metrics = workdir / f"{name}.json"
+    port = free_port()
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "o365creeper.mockserver",
+            "--port",
+            str(port),
+            "--latency",
+            str(latency),
+            *scenario.mock,
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(port)
+        wall, code, cpu, rss = run_client(
+            [
+                "-f",
+                str(addresses),
+                "-u",
+                f"http://127.0.0.1:{port}",
+                "-q",
+                "--unmanaged",
+                "query",
+                "--metrics",
+                str(metrics),
+                *scenario.client,
+                *extra,
+            ],
+            env,
+        )
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    summary = json.loads(metrics.read_text()) if metrics.exists() else {}
+    latency_ms = summary.get("latency_ms", {})
+    return {
+        "addresses": scenario.addresses,
+        "exit_code": code,
+        "wall_s": round(wall, 2),
+        "throughput": round(scenario.addresses / wall, 1),
+        # the mock server competes for the CPU, this is the client's share
+        "cpu_us": round(cpu / scenario.addresses * 1e6),
+        "requests": summary.get("requests"),
+        "p50_ms": latency_ms.get("p50"),
+        "p90_ms": latency_ms.get("p90"),
+        "p99_ms": latency_ms.get("p99"),
+        "throttled": summary.get("failures", {}).get("throttle"),
+        "peak_rss_mb": round(rss / 1024, 1),
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key, higher_is_better in COMPARED.items():
+            old, new = base.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f"{name}: {key} {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark o365creeper against the local mock server."
+    )
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="Scenario to run (can be used multiple times; default: all but the large ones).",
+    )
+    parser.add_argument(
+        "--latency",
+        default=50,
+        type=float,
+        metavar="MS",
+        help="Mean response time of the mock server (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--save",
+        type=Path,
+        metavar="FILE",
+        help="Write the results to %(metavar)s as JSON.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        metavar="FILE",
+        help="Compare with results saved in %(metavar)s and fail on regressions.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=0.1,
+        type=float,
+        help="Relative change counted as a regression (default: %(default)s).",
+    )
+    parser.add_argument(
+        "extra",
+        nargs="*",
+        metavar="-- OPTION",
+        help="Extra options of the client, e.g. -- --uvloop.",
+    )
+    args = parser.parse_args()
+
+    names = args.scenario or [n for n, s in SCENARIOS.items() if not s.large]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (str(SRC), env.get("PYTHONPATH")) if p
+    )
+
+    results = {}
+    columns = ("wall_s", "throughput", "cpu_us", "p50_ms", "p90_ms", "p99_ms", "throttled", "peak_rss_mb")
+    print(f"{'scenario':<22}" + "".join(f"{c:>13}" for c in columns))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            result = run_scenario(
+                name, SCENARIOS[name], Path(tmp), args.latency, env, args.extra
+            )
+            results[name] = result
+            row = "".join(f"{str(result[c]):>13}" for c in columns)
+            status = "" if result["exit_code"] == 0 else f"  (exit {result['exit_code']})"
+            print(f"{name:<22}{row}{status}", flush=True)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2) + "\n")
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
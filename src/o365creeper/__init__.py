@@ -0,0 +1,5 @@
+from o365creeper.core import CheckResult
+from o365creeper.enumerator import Enumerator, EnumeratorConfig
+from o365creeper.output import ResultRecord
+
+__all__ = ["CheckResult", "Enumerator", "EnumeratorConfig", "ResultRecord"]
@@ -0,0 +1,231 @@
+import asyncio
+import time
+import tomllib
+from collections import Counter
+from contextlib import aclosing
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import List, Optional
+
+from o365creeper.concurrency import FairShare
+from o365creeper.enumerator import Enumerator
+from o365creeper.output import ResultRecord, ResultWriter
+from o365creeper.utils import (
+    count_lines,
+    print_error,
+    print_info,
+    print_success,
+    print_warning,
+    read_lines,
+)
+
+__all__ = ["Batch", "BatchJob", "read_manifest"]
+
+
+@dataclass
+class BatchJob:
+    """A job of a batch manifest: an input list and where its results go.
+
+    ``workers`` caps the requests in flight for the job and ``rate`` its
+    requests per second, on top of the limits of the whole batch.
+    """
+
+    name: str
+    input: Path
+    output: Optional[Path] = None
+    output_format: str = "txt"
+    unresolved: Optional[Path] = None
+    workers: Optional[int] = None
+    rate: Optional[float] = None
+
+
+_PATHS = ("input", "output", "unresolved")
+
+
+def read_manifest(path: Path) -> List[BatchJob]:
+    """Read the jobs of a TOML batch manifest, one ``[[job]]`` table each.
+
+    Relative paths are relative to the directory of the manifest.
+    """
+    with open(path, "rb") as f:
+        manifest = tomllib.load(f)
+    known = {f.name for f in fields(BatchJob)}
+    jobs = []
+    for i, table in enumerate(manifest.get("job", []), 1):
+        unknown = set(table) - known
+        if unknown:
+            raise ValueError(f"job {i}: unknown keys {', '.join(sorted(unknown))}")
+        if "input" not in table:
+            raise ValueError(f"job {i}: missing input")
+        table = dict(table)
+        for key in _PATHS:
+            if key in table:
+                table[key] = path.parent / Path(table[key]).expanduser()
+        table.setdefault("name", table["input"].stem)
+        job = BatchJob(**table)
+        if job.output_format not in ResultWriter.FORMATS:
+            raise ValueError(f"job {i}: unknown output format {job.output_format}")
+        if job.workers is not None and job.workers < 1:
+            raise ValueError(f"job {i}: workers must be at least 1")
+        if job.rate is not None and job.rate <= 0:
+            raise ValueError(f"job {i}: rate must be positive")
+        jobs.append(job)
+    if not jobs:
+        raise ValueError("no [[job]] in manifest")
+    names = Counter(job.name for job in jobs)
+    duplicates = [name for name, n in names.items() if n > 1]
+    if duplicates:
+        raise ValueError(f"duplicate job names: {', '.join(duplicates)}")
+    return jobs
+
+
+class _Progress:
+    __slots__ = ("job", "counts", "total", "started", "finished", "error")
+
+    def __init__(self, job: BatchJob):
+        self.job = job
+        self.counts = Counter()
+        self.total: Optional[int] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def describe(self) -> str:
+        counts = self.counts
+        done = f"{counts['done']}" + (f"/{self.total}" if self.total else "")
+        elapsed = self.elapsed
+        rate = counts["done"] / elapsed if elapsed else 0.0
+        return (
+            f"{done} done in {elapsed:.0f}s ({rate:.1f}/s), "
+            + f"{counts['valid']} valid, {counts['invalid']} invalid, "
+            + f"{counts['unresolved']} unresolved, {counts['skipped']} skipped"
+        )
+
+
+class Batch:
+    """Run the jobs of a manifest concurrently on one enumerator.
+
+    The requests in flight, up to the enumerator's ``maxworkers``, are
+    shared fairly among the jobs with a FairShare: a long list gets no
+    more than a short one while both are running, and the slots of
+    finished jobs go to the others. Sessions, pacing, realm lookups and
+    the cache are shared by all jobs. A line of progress per running job
+    is printed every ``interval`` seconds, and a summary per job at the
+    end. A job failing, e.g. on an unreadable input, does not stop the
+    others.
+    """
+
+    def __init__(
+        self,
+        enumerator: Enumerator,
+        jobs: List[BatchJob],
+        interval: float = 10,
+        quiet: bool = False,
+        show_valid: bool = False,
+    ):
+        self.enumerator = enumerator
+        self.jobs = [_Progress(job) for job in jobs]
+        self.interval = interval
+        self.quiet = quiet
+        self.show_valid = show_valid
+        self.share = FairShare(enumerator.config.maxworkers)
+
+    async def run(self):
+        await self.enumerator.start()
+        reporter = asyncio.create_task(self._report())
+        try:
+            await asyncio.gather(*(self._run_job(p) for p in self.jobs))
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+        self.print_summary()
+
+    def _log(self, progress: _Progress, record: ResultRecord):
+        prefix = f"[{progress.job.name}] {record.address}"
+        if record.outcome == "VALID":
+            if not self.quiet or self.show_valid:
+                print_success(f"{prefix} - VALID")
+        elif self.quiet:
+            return
+        elif record.outcome == "UNRESOLVED":
+            print_error(f"{prefix} - UNRESOLVED: {record.reason}")
+        elif record.outcome == "SKIPPED":
+            print_warning(f"{prefix} - SKIPPED ({record.reason})")
+        else:
+            print_info(f"{prefix} - INVALID")
+
+    async def _count(self, progress: _Progress):
+        # an upper bound, duplicates and comments are counted too
+        try:
+            progress.total = await asyncio.to_thread(count_lines, progress.job.input)
+        except OSError:
+            pass
+
+    async def _run_job(self, progress: _Progress):
+        job = progress.job
+        share = self.share.share(job.workers)
+        counter = asyncio.create_task(self._count(progress))
+        writers = []
+        try:
+            output = unresolved = None
+            if job.output is not None:
+                output = ResultWriter(job.output, job.output_format)
+                await output.open()
+                writers.append(output)
+                if self.enumerator.journal is not None:
+                    self.enumerator.journal.follow(output)
+            if job.unresolved is not None:
+                unresolved = ResultWriter(job.unresolved)
+                await unresolved.open()
+                writers.append(unresolved)
+
+            progress.started = time.monotonic()
+            results = self.enumerator.run(
+                read_lines(job.input), workers=job.workers, rate=job.rate, share=share
+            )
+            async with aclosing(results) as results:
+                async for record in results:
+                    progress.counts["done"] += 1
+                    progress.counts["requests"] += record.attempts
+                    progress.counts[record.outcome.lower()] += 1
+                    self._log(progress, record)
+                    if record.outcome == "UNRESOLVED" and unresolved is not None:
+                        unresolved.write(record)
+                    # the text format only lists valid addresses
+                    if output is not None and (
+                        job.output_format != "txt" or record.outcome == "VALID"
+                    ):
+                        output.write(record)
+        except Exception as e:
+            progress.error = str(e) or type(e).__name__
+            print_error(f"Job {job.name} failed: {progress.error}")
+        finally:
+            progress.finished = time.monotonic()
+            counter.cancel()
+            share.close()
+            for writer in writers:
+                try:
+                    await writer.close()
+                except OSError as e:
+                    print_error(f"Error writing {writer.path}: {e}")
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for progress in self.jobs:
+                if progress.started is not None and progress.finished is None:
+                    print_info(f"{progress.job.name}: {progress.describe()}.")
+
+    def print_summary(self):
+        for progress in self.jobs:
+            line = f"Job {progress.job.name}: {progress.describe()}"
+            if progress.error is not None:
+                print_error(f"{line} (failed: {progress.error}).")
+            else:
+                print_info(f"{line}.")
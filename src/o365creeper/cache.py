@@ -0,0 +1,87 @@
+import sqlite3
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+__all__ = ["ResultCache"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    address TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    checked REAL NOT NULL,
+    baseurl TEXT NOT NULL,
+    PRIMARY KEY (address, baseurl)
+);
+CREATE TABLE IF NOT EXISTS realms (
+    domain TEXT NOT NULL,
+    realm TEXT NOT NULL,
+    checked REAL NOT NULL,
+    baseurl TEXT NOT NULL,
+    PRIMARY KEY (domain, baseurl)
+);
+"""
+
+
+class ResultCache:
+    """Persistent store of lookup outcomes, keyed by normalized address,
+    and of domain realms. Entries are only served for the base URL they
+    were obtained from.
+
+    Entries older than ``ttl`` seconds are considered stale and are not
+    served. Writes are buffered and committed every ``batch_size`` entries
+    and on close.
+    """
+
+    def __init__(self, path: Path, ttl: float, batch_size: int = 500):
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self._pending: List[Tuple[str, str, float, str]] = []
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def get(self, address: str, baseurl: str) -> Optional[str]:
+        """Return the cached outcome for address, or None if unknown or stale."""
+        row = self._db.execute(
+            "SELECT outcome FROM results"
+            + " WHERE address = ? AND baseurl = ? AND checked >= ?",
+            (address, baseurl, time.time() - self.ttl),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, address: str, outcome: str, baseurl: str):
+        self._pending.append((address, outcome, time.time(), baseurl))
+        if len(self._pending) >= self.batch_size:
+            self.commit()
+
+    def get_realm(self, domain: str, baseurl: str) -> Optional[str]:
+        """Return the cached realm of domain, or None if unknown or stale."""
+        row = self._db.execute(
+            "SELECT realm FROM realms"
+            + " WHERE domain = ? AND baseurl = ? AND checked >= ?",
+            (domain, baseurl, time.time() - self.ttl),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_realm(self, domain: str, realm: str, baseurl: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO realms VALUES (?, ?, ?, ?)",
+            (domain, realm, time.time(), baseurl),
+        )
+        self._db.commit()
+
+    def commit(self):
+        if not self._pending:
+            return
+        self._db.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", self._pending
+        )
+        self._db.commit()
+        self._pending = []
+
+    def close(self):
+        self.commit()
+        self._db.close()
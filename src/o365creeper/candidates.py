@@ -0,0 +1,210 @@
+import re
+import string
+import unicodedata
+from collections import Counter
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence
+
+from o365creeper.dedup import normalize_email
+from o365creeper.utils import print_success
+
+__all__ = ["DEFAULT_FORMATS", "FORMATS", "CandidateGenerator", "normalize_name"]
+
+# common address formats; {f} and {l} are the initials
+FORMATS: Dict[str, str] = {
+    "first.last": "{first}.{last}",
+    "flast": "{f}{last}",
+    "firstl": "{first}{l}",
+    "first": "{first}",
+    "firstlast": "{first}{last}",
+    "first_last": "{first}_{last}",
+    "f.last": "{f}.{last}",
+    "first.l": "{first}.{l}",
+    "last.first": "{last}.{first}",
+    "lastfirst": "{last}{first}",
+    "lastf": "{last}{f}",
+    "last": "{last}",
+}
+# most common first
+DEFAULT_FORMATS = ("first.last", "flast", "firstl", "first", "firstlast", "f.last")
+
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]")
+_FIELDS = frozenset(("first", "last", "f", "l"))
+
+
+def normalize_name(name: str) -> str:
+    """Lower-case name and strip accents, spaces and punctuation.
+
+    Args:
+        name (str): Raw name, e.g. "O'Brien" or "José"
+
+    Returns:
+        str: Name usable in an address, e.g. "obrien" or "jose"
+    """
+    name = unicodedata.normalize("NFKD", name.strip().lower())
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return _NON_ALNUM_RE.sub("", name)
+
+
+def _template_fields(template: str) -> FrozenSet[str]:
+    """Return the fields of an address template, checking it is usable.
+
+    Raises:
+        ValueError: The template is malformed, uses no name or a field
+            other than first, last, f and l
+    """
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        raise ValueError(f"Invalid address format {template}: {e}") from None
+    fields = set()
+    for _, field, spec, conversion in parsed:
+        if field is None:
+            continue
+        if field not in _FIELDS or spec or conversion:
+            raise ValueError(
+                f"Invalid address format {template}: "
+                + "only {first}, {last}, {f} and {l} can be used"
+            )
+        fields.add(field)
+    if not fields:
+        raise ValueError(f"Unknown address format: {template}")
+    return frozenset(fields)
+
+
+class _Pattern:
+    __slots__ = ("name", "template", "first", "last")
+
+    def __init__(self, name: str, template: str):
+        fields = _template_fields(template)
+        self.name = name
+        self.template = template
+        self.first = "first" in fields or "f" in fields
+        self.last = "last" in fields or "l" in fields
+
+    def format(self, first: str, last: str) -> str:
+        return self.template.format(first=first, last=last, f=first[:1], l=last[:1])
+
+
+class CandidateGenerator:
+    """Lazily generate candidate addresses from name lists and formats.
+
+    Formats are names from FORMATS or templates using ``{first}``,
+    ``{last}``, ``{f}`` and ``{l}``, in order of priority. Formats using a
+    single name are only combined with the list they use.
+
+    Orders:
+        interleave: every format for one pair of names, then the next pair
+        pattern: every pair of names for one format, then the next format
+
+    Once ``confirm`` addresses of one format have been reported valid with
+    ``confirm_valid``, the other formats are no longer generated, as the
+    tenant evidently uses that one. 0 never stops any format.
+    """
+
+    ORDERS = ("interleave", "pattern")
+
+    def __init__(
+        self,
+        first_names: Iterable[str],
+        last_names: Iterable[str],
+        domain: str,
+        formats: Sequence[str] = DEFAULT_FORMATS,
+        order: str = "interleave",
+        confirm: int = 0,
+        max_origins: int = 100_000,
+    ):
+        if order not in self.ORDERS:
+            raise ValueError(f"Unknown order: {order}")
+        self.patterns: List[_Pattern] = []
+        for f in formats:
+            self.patterns.append(_Pattern(f, FORMATS.get(f, f)))
+        self.first_names = self._names(first_names)
+        self.last_names = self._names(last_names)
+        self.domain = domain.strip().lower()
+        self.order = order
+        self.confirm = confirm
+        self.confirmed: Optional[str] = None
+        self.hits = Counter()
+        self.generated = Counter()
+        # format of recently generated addresses, to credit valid results
+        self._origins: Dict[str, str] = {}
+        self._max_origins = max_origins
+
+    @staticmethod
+    def _names(names: Iterable[str]) -> List[str]:
+        # deduplicated, in the order of the list
+        return list(dict.fromkeys(n for n in map(normalize_name, names) if n))
+
+    def _size(self, pattern: _Pattern) -> int:
+        return (len(self.first_names) if pattern.first else 1) * (
+            len(self.last_names) if pattern.last else 1
+        )
+
+    @property
+    def total(self) -> int:
+        """Number of candidates, so far as known."""
+        if self.confirmed is None:
+            return sum(self._size(p) for p in self.patterns)
+        pattern = next(p for p in self.patterns if p.name == self.confirmed)
+        return sum(self.generated.values()) + max(
+            0, self._size(pattern) - self.generated[pattern.name]
+        )
+
+    def _active(self, pattern: _Pattern) -> bool:
+        return self.confirmed is None or self.confirmed == pattern.name
+
+    def _emit(self, pattern: _Pattern, first: str, last: str) -> Optional[str]:
+        address = normalize_email(f"{pattern.format(first, last)}@{self.domain}")
+        self.generated[pattern.name] += 1
+        if address is not None and self.confirm:
+            if len(self._origins) >= self._max_origins:
+                del self._origins[next(iter(self._origins))]
+            self._origins.setdefault(address, pattern.name)
+        return address
+
+    def _pairs(self, pattern: _Pattern):
+        firsts = self.first_names if pattern.first else [""]
+        lasts = self.last_names if pattern.last else [""]
+        for first in firsts:
+            for last in lasts:
+                yield first, last
+
+    def __iter__(self) -> Iterator[str]:
+        if self.order == "pattern":
+            for pattern in self.patterns:
+                for first, last in self._pairs(pattern):
+                    if not self._active(pattern):
+                        break
+                    address = self._emit(pattern, first, last)
+                    if address is not None:
+                        yield address
+            return
+
+        for i, first in enumerate(self.first_names or [""]):
+            for j, last in enumerate(self.last_names or [""]):
+                if j and not any(p.last and self._active(p) for p in self.patterns):
+                    break
+                for pattern in self.patterns:
+                    # formats using a single name only once per name
+                    if (not pattern.first and i) or (not pattern.last and j):
+                        continue
+                    if (pattern.first and not first) or (pattern.last and not last):
+                        continue
+                    if not self._active(pattern):
+                        continue
+                    address = self._emit(pattern, first, last)
+                    if address is not None:
+                        yield address
+
+    def confirm_valid(self, address: str):
+        """Credit a valid address to the format that generated it."""
+        name = self._origins.pop(address, None)
+        if name is None or self.confirmed is not None or not self.confirm:
+            return
+        self.hits[name] += 1
+        if self.hits[name] >= self.confirm:
+            self.confirmed = name
+            print_success(
+                f"Address format {name} confirmed for {self.domain}, "
+                + "not generating other formats anymore."
+            )
@@ -0,0 +1,280 @@
+import asyncio
+import base64
+import gzip
+import os
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from o365creeper.core import CheckResult, parse_credential_type, parse_realm
+from o365creeper.jsonlib import dumps as json_dumps
+from o365creeper.jsonlib import loads as json_loads
+from o365creeper.output import ResultRecord
+from o365creeper.retry import classify, describe, next_delay
+from o365creeper.utils import print_error
+from o365creeper.writer import BatchedWriter
+
+__all__ = ["Capture", "read_capture", "replay"]
+
+# members are read and checked in chunks of this size
+_CHUNK = 1 << 20
+
+
+class CapturedError(Exception):
+    """An exception raised during a captured exchange, as replayed."""
+
+
+class CapturedTimeout(CapturedError, asyncio.TimeoutError):
+    pass
+
+
+def _members(f) -> Iterator[bytes]:
+    # yield the data of each complete gzip member; a truncated last member,
+    # as left by a crash, ends the iteration
+    d = zlib.decompressobj(wbits=31)
+    parts = []
+    while True:
+        chunk = f.read(_CHUNK)
+        if not chunk:
+            return
+        while chunk:
+            parts.append(d.decompress(chunk))
+            if not d.eof:
+                break
+            yield b"".join(parts)
+            parts = []
+            chunk = d.unused_data
+            d = zlib.decompressobj(wbits=31)
+
+
+def _complete_length(path: Path) -> int:
+    # length of the leading complete gzip members of the file at path
+    length = 0
+    with open(path, "rb") as f:
+        d = zlib.decompressobj(wbits=31)
+        offset = 0
+        while True:
+            chunk = f.read(_CHUNK)
+            if not chunk:
+                return length
+            while chunk:
+                d.decompress(chunk)
+                if not d.eof:
+                    offset += len(chunk)
+                    break
+                offset += len(chunk) - len(d.unused_data)
+                length = offset
+                chunk = d.unused_data
+                d = zlib.decompressobj(wbits=31)
+
+
+def read_capture(path: Path) -> Iterator[Dict]:
+    """Yield the exchanges recorded in a capture, in order.
+
+    A truncated last batch, as left by a crash, is ignored.
+    """
+    with open(path, "rb") as f:
+        for data in _members(f):
+            for line in data.splitlines():
+                yield json_loads(line)
+
+
+def _body(body: Optional[bytes]) -> Dict:
+    if body is None:
+        return {}
+    try:
+        return {"body": body.decode()}
+    except UnicodeDecodeError:
+        return {"body_b64": base64.b64encode(body).decode()}
+
+
+def _headers(headers) -> Dict[str, str]:
+    # a repeated header keeps its last value
+    return {str(k): v for k, v in (headers or {}).items()}
+
+
+def _error(e: Optional[Exception]) -> Dict:
+    if e is None:
+        return {}
+    return {
+        "error": str(e) or type(e).__name__,
+        "timeout": isinstance(e, asyncio.TimeoutError),
+    }
+
+
+class Capture(BatchedWriter):
+    """Append-only, gzip-compressed record of raw HTTP exchanges.
+
+    Every GetCredentialType and getuserrealm.srf exchange is kept as one
+    JSON object with the request, the response status, headers and body,
+    the time it took and any error, so that runs can be re-evaluated
+    offline with ``replay``.
+
+    Exchanges are buffered and written in batches, either when
+    ``batch_size`` are pending or every ``interval`` seconds. Each batch is
+    compressed as a gzip member of its own and appended, so the file stays
+    readable with zcat and a crash loses at most the last batch. A failed
+    write stops the capture, rather than the run, and is raised by
+    ``close``.
+    """
+
+    async def _open(self):
+        if self.path.exists():
+            # drop a last batch left incomplete by a crash
+            length = await asyncio.to_thread(_complete_length, self.path)
+            if length != self.path.stat().st_size:
+                os.truncate(self.path, length)
+        return open(self.path, "ab")
+
+    def _add(self, exchange: Dict):
+        if self._error is None:
+            self._append(json_dumps(exchange) + "\n")
+
+    def credential(
+        self,
+        res: CheckResult,
+        url: str,
+        headers: Dict,
+        resp_headers,
+        body: Optional[bytes],
+    ):
+        self._add(
+            {
+                "type": "credential",
+                "time": time.time(),
+                "url": url,
+                "email": res.email,
+                "headers": _headers(headers),
+                "status": res.status,
+                "resp_headers": _headers(resp_headers),
+                **_body(body),
+                "elapsed": res.elapsed,
+                **_error(res.error),
+            }
+        )
+
+    def realm(
+        self,
+        domain: str,
+        url: str,
+        status: Optional[int],
+        resp_headers,
+        body: Optional[bytes],
+        elapsed: float,
+        error: Optional[Exception] = None,
+    ):
+        self._add(
+            {
+                "type": "realm",
+                "time": time.time(),
+                "url": url,
+                "domain": domain,
+                "status": status,
+                "resp_headers": _headers(resp_headers),
+                **_body(body),
+                "elapsed": elapsed,
+                **_error(error),
+            }
+        )
+
+    def _format(self, batch: List[str]) -> bytes:
+        return "".join(batch).encode()
+
+    def _write(self, data: bytes):
+        self._file.write(gzip.compress(data, compresslevel=6))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _failed(self, error: Exception):
+        print_error(f"Error writing capture, not capturing anymore: {error}")
+
+
+def _replayed_body(exchange: Dict) -> Optional[bytes]:
+    if "body" in exchange:
+        return exchange["body"].encode()
+    if "body_b64" in exchange:
+        return base64.b64decode(exchange["body_b64"])
+    return None
+
+
+def _replayed_error(exchange: Dict) -> Optional[Exception]:
+    if "error" not in exchange:
+        return None
+    cls = CapturedTimeout if exchange.get("timeout") else CapturedError
+    return cls(exchange["error"])
+
+
+def replay(
+    path: Path,
+    retry: int = 3,
+    stats: Optional[Counter] = None,
+    on_retry: Optional[Callable[[str, str, str], None]] = None,
+    realms: Optional[Dict[str, str]] = None,
+) -> Iterator[ResultRecord]:
+    """Re-evaluate a capture, yielding a record for each address once final.
+
+    Captured responses go through the same parsing, classification and
+    retry policies as in a live run: a failure either gives up on the
+    address, with an UNRESOLVED record, or is followed by the retry
+    captured later on (``on_retry`` is called as in Enumerator.run).
+    Addresses left without a final response when the capture ends are
+    UNRESOLVED too. The realms of captured lookups are put in ``realms``.
+    """
+    stats = stats if stats is not None else Counter()
+    attempts: Dict[str, int] = {}
+    for exchange in read_capture(path):
+        if exchange.get("type") == "realm":
+            stats["realm"] += 1
+            body = _replayed_body(exchange)
+            if realms is not None and body is not None:
+                realms[exchange["domain"]] = parse_realm(body.decode(errors="replace"))
+            continue
+
+        username = exchange["email"]
+        res = CheckResult(
+            username,
+            status=exchange.get("status"),
+            elapsed=exchange.get("elapsed", 0.0),
+            error=_replayed_error(exchange),
+        )
+        body = _replayed_body(exchange)
+        if res.error is None and body is not None:
+            parse_credential_type(res, body)
+        stats["requests"] += 1
+        kind = classify(res)
+        attempt = attempts.pop(username, 0)
+        record = ResultRecord(
+            username,
+            res.state,
+            code=res.code,
+            http_status=res.status,
+            attempts=attempt + 1,
+            latency_ms=round(res.elapsed * 1000, 1),
+            timestamp=exchange.get("time", 0.0),
+        )
+        if kind is not None:
+            stats[kind] += 1
+            reason = describe(res, kind)
+            attempt += 1
+            if next_delay(kind, attempt, retry) is not None:
+                if on_retry is not None:
+                    on_retry(username, kind, reason)
+                attempts[username] = attempt
+                continue
+            record.outcome = "UNRESOLVED"
+            record.reason = f"{reason} (gave up after {attempt} attempts)"
+        stats["done"] += 1
+        stats[record.outcome.lower()] += 1
+        yield record
+
+    for username, attempt in attempts.items():
+        stats["done"] += 1
+        stats["unresolved"] += 1
+        yield ResultRecord(
+            username,
+            "UNRESOLVED",
+            attempts=attempt,
+            reason="no final response in the capture",
+        )
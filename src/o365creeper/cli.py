@@ -18,24 +18,48 @@
 
 import argparse
 import asyncio
-import aiofiles
+import itertools
+import sqlite3
 import sys
+import zlib
+from collections import Counter
+from contextlib import aclosing, nullcontext
 from pathlib import Path
+from typing import AsyncIterator, Optional
 
 import aiohttp
-from colorama import Fore
 
-from o365creeper.core import check_email, verify_domain, need_retry
-from o365creeper.tor import create_tor_sessions, test_tor, test_circuits
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from o365creeper.capture import Capture, replay
+from o365creeper.batch import Batch, read_manifest
+from o365creeper.candidates import DEFAULT_FORMATS, FORMATS, CandidateGenerator
+from o365creeper.concurrency import AdaptiveLimiter
+from o365creeper.core import IF_EXISTS_RESULTS, verify_domain
+from o365creeper.daemon import Daemon, submit
+from o365creeper.dedup import Deduplicator
+from o365creeper.enumerator import Enumerator, EnumeratorConfig
+from o365creeper.output import ResultRecord, ResultWriter
+from o365creeper.pool import SessionPool
+from o365creeper.profiling import PROFILER, profile, write_summary
+from o365creeper.progress import StatusLine
+from o365creeper.realm import RealmResolver
+from o365creeper.retry import RETRY_POLICIES
+from o365creeper.timeouts import AdaptiveTimeout, client_timeout
+from o365creeper.tor import test_tor, test_circuits
 from o365creeper.utils import (
-    get_list_from_file,
+    count_lines,
+    iter_lines,
     print_error,
+    read_lines,
     print_info,
     print_success,
     print_warning,
 )
 
-
 async def main():
     parser = argparse.ArgumentParser(
         description=(
@@ -53,7 +77,20 @@ async def main():
         "-f",
         "--file",
         type=Path,
-        help="List of email addresses to validate, one per line.",
+        help=(
+            "List of email addresses to validate, one per line, - for stdin; "
+            + "may be compressed with gzip, xz or zstd."
+        ),
+    )
+    group.add_argument(
+        "-g",
+        "--generate",
+        type=str,
+        metavar="DOMAIN",
+        help=(
+            "Validate candidate addresses in %(metavar)s generated from "
+            + "--first-names and --last-names."
+        ),
     )
     group.add_argument(
         "--tor-test",
@@ -67,6 +104,78 @@ async def main():
         metavar="DOMAIN",
         help="Check if %(metavar)s is managed by MicrosoftOnline and exit.",
     )
+    group.add_argument(
+        "--serve",
+        metavar="ADDRESS",
+        help=(
+            "Run as a daemon serving jobs at %(metavar)s, a Unix socket path or "
+            + "HOST:PORT, with warm sessions, realm lookups and cache."
+        ),
+    )
+    group.add_argument(
+        "--batch",
+        type=Path,
+        metavar="MANIFEST",
+        help=(
+            "Run the jobs of the TOML %(metavar)s at once, sharing the workers "
+            + "fairly among them (see README)."
+        ),
+    )
+    group.add_argument(
+        "--replay",
+        type=Path,
+        metavar="FILE",
+        help=(
+            "Re-evaluate the exchanges captured in %(metavar)s with --capture, "
+            + "without sending any request."
+        ),
+    )
+    parser.add_argument(
+        "--submit",
+        metavar="ADDRESS",
+        help="Send the addresses to the daemon serving at %(metavar)s (see --serve).",
+    )
+    parser.add_argument(
+        "--first-names",
+        type=Path,
+        metavar="FILE",
+        help="List of first names for --generate, one per line.",
+    )
+    parser.add_argument(
+        "--last-names",
+        type=Path,
+        metavar="FILE",
+        help="List of last names for --generate, one per line.",
+    )
+    parser.add_argument(
+        "--formats",
+        default=",".join(DEFAULT_FORMATS),
+        metavar="LIST",
+        help=(
+            "Comma-separated address formats for --generate, most likely "
+            + f"first: {', '.join(FORMATS)} or templates such as "
+            + "'{first}-{last}' (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--format-order",
+        choices=CandidateGenerator.ORDERS,
+        default="interleave",
+        help=(
+            "Try every format for each name before the next name, or every "
+            + "name for each format before the next format (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--confirm",
+        default=0,
+        type=int,
+        metavar="N",
+        help=(
+            "Stop generating other formats once %(metavar)s addresses of one "
+            + "format are valid; 0 never stops (default: %(default)s)."
+        ),
+    )
     parser.add_argument(
         "-u",
         "--baseurl",
@@ -78,7 +187,25 @@ async def main():
         "-o",
         "--output",
         type=Path,
-        help="Output valid email addresses to the specified file.",
+        help=(
+            "Output valid email addresses to the specified file, - for stdout; "
+            + "compressed when ending with .gz, .xz or .zst."
+        ),
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=ResultWriter.FORMATS,
+        default="txt",
+        help=(
+            "Format of --output: valid addresses only as text, or every "
+            + "outcome with its details as JSON lines or CSV (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--unresolved",
+        type=Path,
+        metavar="FILE",
+        help="Output addresses that could not be checked after all retries to %(metavar)s.",
     )
     parser.add_argument(
         "--tor",
@@ -100,24 +227,104 @@ async def main():
         type=int,
         help="Number of Tor circuits to create (default: %(default)s).",
     )
+    parser.add_argument(
+        "--sessions",
+        default=1,
+        type=int,
+        metavar="N",
+        help=(
+            "Number of HTTP sessions to share among workers when not using "
+            + "Tor (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--session-max-errors",
+        default=0.5,
+        type=float,
+        metavar="RATIO",
+        help=(
+            "Quarantine and rebuild a session (Tor circuit) once this share of "
+            + "its recent requests failed (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--connection",
+        choices=("keep-alive", "close"),
+        default="keep-alive",
+        help=(
+            "Reuse pooled connections or open a new one for every request "
+            + "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--keepalive",
+        default=30,
+        type=float,
+        metavar="TIME",
+        help=(
+            "Close pooled connections idle for %(metavar)s seconds "
+            + "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--warm-up",
+        action="store_true",
+        help="Open pooled connections before starting the workers.",
+    )
     parser.add_argument(
         "--timeout",
         default=30,
-        type=int,
+        type=float,
+        metavar="TIME",
+        help=(
+            "Give up on a request after %(metavar)s seconds in total, "
+            + "0 for no limit (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        default=10,
+        type=float,
+        metavar="TIME",
+        help=(
+            "Give up on connecting, including the Tor circuit and TLS "
+            + "handshake, after %(metavar)s seconds (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--read-timeout",
+        default=20,
+        type=float,
         metavar="TIME",
         help=(
-            "Stop waiting for a response after %(metavar)s "
-            + "seconds (default: %(default)s)."
+            "Give up on a response once nothing is received for %(metavar)s "
+            + "seconds, the upper bound with --adaptive-timeout "
+            + "(default: %(default)s)."
         ),
     )
+    parser.add_argument(
+        "--adaptive-timeout",
+        action="store_true",
+        help=(
+            "Cut off responses taking --timeout-factor times longer than the "
+            + "recent 99th percentile, to retry stalled requests early."
+        ),
+    )
+    parser.add_argument(
+        "--timeout-factor",
+        default=3.0,
+        type=float,
+        metavar="X",
+        help="Multiple of the latency for --adaptive-timeout (default: %(default)s).",
+    )
     parser.add_argument(
         "--retry",
         default=3,
         type=int,
         metavar="N",
         help=(
-            "Retry up to %(metavar)s times in case of error "
-            + "(default: %(default)s)."
+            "Retry up to %(metavar)s times in case of error, with exponential "
+            + "backoff (default: %(default)s)."
         ),
     )
     parser.add_argument(
@@ -126,14 +333,174 @@ async def main():
         dest="maxworkers",
         type=int,
         default=20,
-        help="Maximum number of simultaneous workers (default: %(default)s)",
+        help="Maximum number of requests in flight (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help=(
+            "Adapt the number of requests in flight (up to --max-workers) to "
+            + "throttling and latency."
+        ),
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        metavar="RPS",
+        help="Send at most %(metavar)s requests per second in total.",
+    )
+    parser.add_argument(
+        "--burst",
+        default=1,
+        type=int,
+        metavar="N",
+        help="Allow bursts of up to %(metavar)s requests above --rate (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--session-rate",
+        type=float,
+        metavar="RPS",
+        help="Send at most %(metavar)s requests per second through each session.",
     )
     parser.add_argument(
         "-s",
         "--sleep",
         default=0,
+        type=float,
+        help=(
+            "Sleep this many seconds after each try in every worker; prefer "
+            + "--rate (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--dedup",
+        choices=Deduplicator.MODES,
+        default="exact",
+        help=(
+            "How to drop duplicate addresses: exact hash set, memory-bounded "
+            + "Bloom filter (may skip a small fraction of unique addresses) "
+            + "or off (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--dedup-capacity",
+        default=10_000_000,
+        type=int,
+        metavar="N",
+        help=(
+            "Expected number of unique addresses when using --dedup bloom "
+            + "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--journal",
+        type=Path,
+        metavar="FILE",
+        help="Record every finished address and its outcome in %(metavar)s.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip addresses already recorded in the journal.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        type=Path,
+        metavar="FILE",
+        help="Reuse and store lookup results in the SQLite database %(metavar)s.",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        default=7 * 24 * 3600,
         type=int,
-        help="Sleep this many seconds between tries (default: %(default)s).",
+        metavar="TIME",
+        help=(
+            "Only reuse cached results younger than %(metavar)s seconds "
+            + "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Query every address again, ignoring cached results.",
+    )
+    parser.add_argument(
+        "--capture",
+        type=Path,
+        metavar="FILE",
+        help=(
+            "Append every raw HTTP request and response to %(metavar)s "
+            + "(gzip-compressed JSON lines), for --replay."
+        ),
+    )
+    parser.add_argument(
+        "--unmanaged",
+        choices=RealmResolver.POLICIES,
+        default="ask",
+        help=(
+            "What to do with addresses in domains not managed by "
+            + "MicrosoftOnline: ask once per domain, skip them or query "
+            + "them anyway (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Show a status line instead of one line per address.",
+    )
+    parser.add_argument(
+        "--show-valid",
+        action="store_true",
+        help="Still print valid addresses with --quiet.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        metavar="FILE",
+        help=(
+            "Write a JSON summary of latencies, rates, queue depths and "
+            + "per-session stats to %(metavar)s at exit."
+        ),
+    )
+    parser.add_argument(
+        "--metrics-stream",
+        type=Path,
+        metavar="FILE",
+        help="Append a JSON line of metrics to %(metavar)s every --metrics-interval.",
+    )
+    parser.add_argument(
+        "--prometheus",
+        type=Path,
+        metavar="FILE",
+        help="Export metrics to the Prometheus textfile %(metavar)s every --metrics-interval.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        default=5,
+        type=float,
+        metavar="TIME",
+        help="Sample metrics every %(metavar)s seconds (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="FILE",
+        help=(
+            "Profile the run and write pstats data to %(metavar)s, and the time "
+            + "spent in each stage and the event loop lag to %(metavar)s.stages.json."
+        ),
+    )
+    parser.add_argument(
+        "--uvloop",
+        action="store_true",
+        help=(
+            "Run on the faster uvloop event loop (speedups extra), or on "
+            + "asyncio's if it is not installed."
+        ),
     )
     parser.add_argument(
         "-H",
@@ -144,72 +511,120 @@ async def main():
     )
 
     args = parser.parse_args()
-
-    headers = {"Connection": "close"}
+    if args.resume and args.journal is None:
+        parser.error("--resume requires --journal")
+    for option in ("rate", "session_rate"):
+        if getattr(args, option) is not None and getattr(args, option) <= 0:
+            parser.error(f"--{option.replace('_', '-')} must be positive")
+    candidates = None
+    if args.generate:
+        try:
+            candidates = CandidateGenerator(
+                iter_lines(args.first_names) if args.first_names else [],
+                iter_lines(args.last_names) if args.last_names else [],
+                args.generate,
+                formats=[f.strip() for f in args.formats.split(",") if f.strip()],
+                order=args.format_order,
+                confirm=args.confirm,
+            )
+        except ValueError as e:
+            parser.error(str(e))
+        except OSError as e:
+            parser.error(f"cannot read names: {e}")
+        if not candidates.total:
+            parser.error("--generate needs the name lists its --formats use")
+
+    headers = {}
+    if args.connection == "close":
+        headers["Connection"] = "close"
     # include custom headers
     if args.headers:
         for header in args.headers:
             h, v = header.split(":", 1)
             headers[h.strip()] = v.strip()
 
-    if args.domain is None and not args.tor_test:
-        usernames = [args.email] if args.email else get_list_from_file(args.file)
-
-    config = {
-        "tor": {
-            "use": args.tor,
-            "socks_port": args.socks_port,
-            "pool_size": args.tor_pool,
-            "test": args.tor_test,
-        },
-        "files": {
-            "input": args.file,
-            "output": args.output,
-        },
-        "email": args.email,
-        "timeout": args.timeout,
-        "retry": args.retry,
-        "sleep": args.sleep,
-        "headers": headers,
-        "baseurl": args.baseurl.strip("/"),
-        "url": args.baseurl.strip("/") + "/common/GetCredentialType",
-    }
-
-    timeout = aiohttp.ClientTimeout(total=args.timeout)
-    queue = asyncio.Queue()
-    output_queue = asyncio.Queue()
-    session_queue = asyncio.Queue()
-
-    tor_config = config["tor"]
+    config = EnumeratorConfig(
+        baseurl=args.baseurl,
+        headers=headers,
+        timeout=args.timeout,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        adaptive_timeout=args.adaptive_timeout,
+        timeout_factor=args.timeout_factor,
+        retry=args.retry,
+        maxworkers=args.maxworkers,
+        adaptive=args.adaptive,
+        sleep=args.sleep,
+        rate=args.rate,
+        burst=args.burst,
+        session_rate=args.session_rate,
+        sessions=args.sessions,
+        session_max_errors=args.session_max_errors,
+        connection=args.connection,
+        keepalive=args.keepalive,
+        warm_up=args.warm_up,
+        tor=args.tor,
+        socks_port=args.socks_port,
+        tor_pool=args.tor_pool,
+        dedup=args.dedup,
+        dedup_capacity=args.dedup_capacity,
+        journal=args.journal,
+        resume=args.resume,
+        cache=args.cache,
+        cache_ttl=args.cache_ttl,
+        refresh=args.refresh,
+        capture=args.capture,
+        unmanaged=args.unmanaged,
+        metrics=any(
+            p is not None for p in (args.metrics, args.metrics_stream, args.prometheus)
+        ),
+        metrics_interval=args.metrics_interval,
+        metrics_stream=args.metrics_stream,
+        prometheus=args.prometheus,
+        stage_times=args.profile is not None,
+    )
 
     # test tor configuration and exit
-    if tor_config["test"]:
+    if args.tor_test:
         try:
             print_info("Testing Tor configuration...")
-            await test_tor(tor_config["socks_port"])
+            await test_tor(args.socks_port)
             print_info("Testing Tor circuits...")
-            await test_circuits(tor_config["socks_port"], tor_config["pool_size"])
+            await test_circuits(args.socks_port, args.tor_pool)
             print_info("Tor configuration test completed.")
             sys.exit()
         except Exception as e:
             print_error(f"Error testing Tor: {e}")
             sys.exit(1)
 
-    if tor_config["use"]:
+    if args.tor:
         try:
-            await test_tor(tor_config["socks_port"])
+            await test_tor(args.socks_port)
         except Exception as e:
             print_error(f"Error testing Tor: {e}")
             sys.exit(1)
 
     # only verify if domain is managed
     if args.domain:
-        if await verify_domain(
-            args.domain,
-            config["baseurl"],
-            tor_config=tor_config,
-            timeout=timeout,
-        ):
+        tor_config = {"use": args.tor, "socks_port": args.socks_port}
+        capture = None
+        if args.capture is not None:
+            capture = Capture(args.capture)
+            await capture.open()
+        try:
+            managed = await verify_domain(
+                args.domain,
+                config.baseurl,
+                tor_config=tor_config,
+                capture=capture,
+                timeout=client_timeout(
+                    args.timeout, args.connect_timeout, args.read_timeout
+                ),
+            )
+        finally:
+            if capture is not None:
+                await capture.close()
+        if managed:
             print_success(
                 f"Domain {args.domain} is MANAGED by MicrosoftOnline."
                 + " You may use this tool to enumerate users."
@@ -222,132 +637,356 @@ async def main():
             )
             sys.exit()
 
-    username_count = len(usernames)
-    # verify if domain is managed before trying to enumerate
-    if username_count > 0:
-        domain = usernames[0].split(sep="@")[1]
-        if not await verify_domain(
-            domain, config["baseurl"], tor_config=tor_config, timeout=timeout
-        ):
-            while True:
-                c = (
-                    input(
-                        f"{Fore.YELLOW} Domain {domain} is NOT MANAGED "
-                        + "by MicrosoftOnline. Trying to enumerate may lead to"
-                        + f" unexpected results.{Fore.RESET} "
-                        + "Do you wish to continue? [y/N] "
-                    )
-                    or "N"
-                )
-                if c.upper() == "Y":
-                    break
-                elif c.upper() == "N":
-                    sys.exit()
-
-    sessions = []
-    # Create sessions
-    if tor_config["use"]:
-        sessions = await create_tor_sessions(
-            tor_config["socks_port"], tor_config["pool_size"], args.timeout
-        )
+    # serve jobs until interrupted
+    if args.serve is not None:
+        await serve(args.serve, config)
+        return
+
+    if args.batch is not None:
+        await run_batch(args.batch, config, args.quiet, args.show_valid)
+        return
+
+    # peek at the first address without consuming the rest of the input
+    if candidates is not None:
+        usernames = iter(candidates)
+    elif args.email:
+        usernames = iter([args.email])
+    elif args.replay is not None:
+        usernames = iter(())
     else:
-        sessions.append(aiohttp.ClientSession(timeout=timeout))
+        # read in a thread, the input may be a pipe or compressed
+        usernames = read_lines(args.file)
+    try:
+        if isinstance(usernames, AsyncIterator):
+            first = await anext(usernames, None)
+        else:
+            first = next(usernames, None)
+    except OSError as e:
+        print_error(f"Error reading input: {e}")
+        sys.exit(1)
+    if first is not None:
+        if isinstance(usernames, AsyncIterator):
+            usernames = prepend(first, usernames)
+        else:
+            usernames = itertools.chain([first], usernames)
 
-    for s in sessions:
-        await session_queue.put(s)
+    def log_address(print_fn, message: str):
+        # per-address lines are replaced by the status line in quiet mode
+        if not args.quiet:
+            print_fn(message)
 
-    for username in usernames:
-        await queue.put(username)
+    def on_retry(username: str, kind: str, reason: str):
+        if kind == "throttle":
+            log_address(print_warning, f"{username} - THROTTLED (will retry)")
+        else:
+            log_address(print_error, f"{username} - {reason} (will retry)")
+
+    def report(record: ResultRecord):
+        if record.outcome == "SKIPPED":
+            log_address(print_warning, f"{record.address} - SKIPPED ({record.reason})")
+        elif record.outcome == "UNRESOLVED":
+            log_address(print_error, f"{record.address} - UNRESOLVED: {record.reason}")
+            if unresolved is not None:
+                unresolved.write(record)
+        else:
+            # codes other than the plain 0/1 are worth showing
+            note = ""
+            if record.code not in (None, 0, 1):
+                note = (
+                    f" (IfExistsResult={record.code}: "
+                    + f"{IF_EXISTS_RESULTS.get(record.code, 'unknown')})"
+                )
+            if record.outcome == "VALID":
+                if candidates is not None:
+                    candidates.confirm_valid(record.address)
+                    if status is not None:
+                        status.total = candidates.total
+                if not args.quiet or args.show_valid:
+                    print_success(f"{record.address} - VALID{note}")
+            else:
+                log_address(print_info, f"{record.address} - INVALID{note}")
+        # the text format only lists valid addresses
+        if output is not None and (
+            args.output_format != "txt" or record.outcome == "VALID"
+        ):
+            output.write(record)
 
-    async def worker(worker_id: int, sleep: int = config["sleep"]):
-        while True:
+    output = unresolved = None
+    try:
+        if args.output is not None:
+            output = ResultWriter(args.output, args.output_format)
+            await output.open()
+        if args.unresolved is not None:
+            unresolved = ResultWriter(args.unresolved)
+            await unresolved.open()
+    except OSError as e:
+        print_error(f"Error opening output: {e}")
+        if output is not None:
+            await output.close()
+        sys.exit(1)
+
+    enumerator = Enumerator(config, on_retry=on_retry)
+    stats = enumerator.stats
+    status = None
+    tasks = []
+    # profile the run itself, not the argument parsing and checks above
+    with profile(args.profile) if args.profile is not None else nullcontext():
+        try:
+            if args.replay is not None:
+                await replay_capture(args.replay, config.retry, stats, on_retry, report)
+            else:
+                if args.submit is None:
+                    await start(enumerator)
+                    if enumerator.journal is not None and output is not None:
+                        enumerator.journal.follow(output)
+                if enumerator.limiter is not None:
+                    tasks.append(asyncio.create_task(limit_reporter(enumerator.limiter)))
+                if args.quiet:
+                    status = StatusLine(stats, total=1 if args.email else None)
+                    if candidates is not None:
+                        status.total = candidates.total
+                    tasks.append(asyncio.create_task(status.run()))
+                    if args.file is not None and str(args.file) != "-":
+                        tasks.append(asyncio.create_task(count_input(status, args.file)))
+
+                if first is not None:
+                    if args.submit is not None:
+                        job_name = args.email or args.generate or str(args.file)
+                        results = submit(args.submit, usernames, name=job_name)
+                    else:
+                        results = enumerator.run(usernames)
+                    async with aclosing(results) as results:
+                        try:
+                            async for record in results:
+                                if args.submit is not None:
+                                    count_result(stats, record)
+                                report(record)
+                        except aiohttp.ClientError as e:
+                            print_error(f"Error submitting to {args.submit}: {e}")
+                        except OSError as e:
+                            # reading the input or writing the journal failed
+                            print_error(f"Error: {e}")
+        finally:
+            # also reached on Ctrl-C, so that finished work is not lost
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            # write out everything still buffered
+            for writer in (output, unresolved):
+                if writer is None:
+                    continue
+                try:
+                    await writer.close()
+                except OSError as e:
+                    print_error(f"Error writing {writer.path}: {e}")
             try:
-                username = await queue.get()
-                session = await session_queue.get()
+                await enumerator.stop()
+            except OSError as e:
+                print_error(f"Error writing journal or capture: {e}")
+
+            if enumerator.metrics is not None and args.metrics is not None:
                 try:
-                    res = await check_email(
-                        session=session,
-                        config=config,
-                        email=username,
-                        headers=headers.copy(),
-                    )
-                    # is endpoint throttling requests or some error occured?
-                    if await need_retry(res):
-                        if res["throttle"]:
-                            print_warning(f"{username} - THROTTLED (will retry)")
-                        else:
-                            print_error(f'{username} - {res["exception"]} (will retry)')
-                        await queue.put(username)
-                    else:
-                        # is valid email?
-                        if res["valid"]:
-                            print_success(f"{username} - VALID")
-                            if config["files"]["output"] is not None:
-                                await output_queue.put(username)
-                        else:
-                            print_info(f"{username} - INVALID")
-
-                except Exception as e:
-                    print_error(f"Worker {worker_id}: {e}")
-
-                finally:
-                    await session_queue.put(session)
-                    queue.task_done()
-                    if sleep > 0:
-                        await asyncio.sleep(sleep)
-
-            except asyncio.CancelledError:
-                break
-
-    writer_tasks = []
-    if config["files"]["output"] is not None:
-        writer_tasks.append(
-            asyncio.create_task(file_writer(output_queue, config["files"]["output"]))
-        )
+                    enumerator.metrics.write_summary(args.metrics)
+                except OSError as e:
+                    print_error(f"Error writing metrics: {e}")
 
-    # start workers and wait for queue to be processed
-    workers = [asyncio.create_task(worker(i, sleep=config["sleep"])) for i in range(args.maxworkers)]
-    await queue.join()
-    for w in workers:
-        w.cancel()
-    await asyncio.gather(*workers, return_exceptions=True)
+    print_summary(stats, enumerator.pool, enumerator.read_timeout)
+    if args.profile is not None:
+        report_profile(args.profile, enumerator)
 
-    # wait for all output to be written
-    await output_queue.join()
-    for task in writer_tasks:
-        task.cancel()
-    await asyncio.gather(*writer_tasks, return_exceptions=True)
 
-    # finally, close sessions
-    await asyncio.gather(*(s.close() for s in sessions))
+async def prepend(item, rest: AsyncIterator):
+    yield item
+    async for x in rest:
+        yield x
 
 
-async def file_writer(queue: asyncio.Queue, path: Path):
-    async with aiofiles.open(path, mode="a") as f:
-        while True:
-            try:
-                line = await queue.get()
+async def replay_capture(path: Path, retry: int, stats: Counter, on_retry, report):
+    realms = {}
+    try:
+        for i, record in enumerate(replay(path, retry, stats, on_retry, realms)):
+            report(record)
+            if i % 1000 == 999:
+                # let the writers flush
+                await asyncio.sleep(0)
+    except (OSError, ValueError, zlib.error) as e:
+        print_error(f"Error reading capture: {e}")
+    for domain, realm in sorted(realms.items()):
+        print_info(f"Domain {domain}: {realm}.")
+    print_info(f"Replayed {stats['requests']} requests from {path}.")
+
+
+async def start(enumerator: Enumerator):
+    # a cache, journal or capture file that cannot be opened is a usage
+    # error, not a crash
+    try:
+        await enumerator.start()
+    except sqlite3.Error as e:
+        print_error(f"Error opening cache {enumerator.config.cache}: {e}")
+        sys.exit(1)
+    except OSError as e:
+        print_error(f"Error opening journal or capture: {e}")
+        sys.exit(1)
+
+
+async def serve(address: str, config: EnumeratorConfig):
+    # there is nobody to ask about unmanaged domains, and results are kept
+    # for later jobs even without a cache file
+    if config.unmanaged == "ask":
+        config.unmanaged = "skip"
+    if config.cache is None:
+        config.cache = Path(":memory:")
+    enumerator = Enumerator(config)
+    try:
+        await start(enumerator)
+        await Daemon(enumerator).serve(address)
+    except OSError as e:
+        print_error(f"Error serving at {address}: {e}")
+        sys.exit(1)
+    finally:
+        await enumerator.stop()
+        print_summary(enumerator.stats, enumerator.pool, enumerator.read_timeout)
 
-                await f.write(line + "\n")
-                await f.flush()
 
-                queue.task_done()
+async def run_batch(path: Path, config: EnumeratorConfig, quiet: bool, show_valid: bool):
+    try:
+        jobs = read_manifest(path)
+    except (OSError, ValueError) as e:
+        print_error(f"Error reading {path}: {e}")
+        sys.exit(1)
+    enumerator = Enumerator(config)
+    try:
+        await start(enumerator)
+        await Batch(enumerator, jobs, quiet=quiet, show_valid=show_valid).run()
+    finally:
+        await enumerator.stop()
+        print_summary(enumerator.stats, enumerator.pool, enumerator.read_timeout)
 
-            except asyncio.CancelledError:
-                break
 
+def count_result(stats: Counter, record: ResultRecord):
+    # what the enumerator counts itself, for results of a daemon
+    stats["done"] += 1
+    stats["requests"] += record.attempts
+    stats[record.outcome.lower()] += 1
+    if record.cached:
+        stats["cache_hit"] += 1
 
-def run():
+
+def report_profile(path: Path, enumerator: Enumerator):
+    stages_path = path.with_name(path.name + ".stages.json")
     try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
+        write_summary(stages_path, enumerator.stages, enumerator.loop_lag)
+    except OSError as e:
+        print_error(f"Error writing stage times: {e}")
+    if enumerator.stages is not None and enumerator.stages.total.count:
+        summary = enumerator.stages.summary()
+        print_info(f"Time per address by stage ({summary['addresses']} addresses):")
+        for name, stage in summary["stages"].items():
+            print_info(
+                f"  {name:<8} {stage['share']:>6.1%}  mean {stage['ms']['mean']:.1f} ms, "
+                + f"p99 {stage['ms']['p99']:.1f} ms"
+            )
+    if enumerator.loop_lag is not None and enumerator.loop_lag.lag.count:
+        lag = enumerator.loop_lag.summary()["ms"]
+        print_info(
+            f"Event loop lag: p50 {lag['p50']:.1f} ms, p99 {lag['p99']:.1f} ms, "
+            + f"max {lag['max']:.1f} ms."
+        )
+    print_info(f"Profile ({PROFILER}) written to {path}, stage times to {stages_path}.")
+
+
+async def limit_reporter(limiter: AdaptiveLimiter, interval: float = 10):
+    last = None
+    while True:
+        await asyncio.sleep(interval)
+        if limiter.limit != last:
+            last = limiter.limit
+            print_info(
+                f"Concurrency limit: {limiter.limit} "
+                + f"(throttled {limiter.last_throttle_ratio:.0%}, "
+                + f"latency {limiter.last_latency * 1000:.0f} ms)"
+            )
+
+
+async def count_input(status: StatusLine, path: Path):
+    # an upper bound, duplicates and comments are counted too
+    try:
+        status.total = await asyncio.to_thread(count_lines, path)
+    except OSError:
         pass
 
 
-if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+def print_summary(
+    stats: Counter,
+    pool: Optional[SessionPool] = None,
+    read_timeout: Optional[AdaptiveTimeout] = None,
+):
+    connections = stats["conn_new"] + stats["conn_reused"]
+    if connections:
+        print_info(
+            f"Connections: {stats['conn_new']} handshakes, "
+            + f"{stats['conn_reused']} reused "
+            + f"({stats['conn_reused'] / connections:.0%} reuse)."
+        )
+    if pool is not None and (pool.size > 1 or any(e.rebuilds for e in pool.entries)):
+        for s in pool.summary():
+            latency = s["mean_latency_ms"]
+            print_info(
+                f"Session {s['session']}: {s['requests']} requests, "
+                + (f"{latency:.0f} ms mean, " if latency is not None else "")
+                + f"{s['errors']} errors, {s['throttled']} throttled, "
+                + f"{s['rebuilds']} rebuilds"
+                + ("" if s["healthy"] else " (quarantined)")
+                + "."
+            )
+    if read_timeout is not None and read_timeout.samples:
+        print_info(
+            f"Adaptive read timeout: {read_timeout.read:g}s "
+            + f"({stats['timeout']} requests timed out)."
+        )
+    if stats["cache_hit"] or stats["cache_miss"]:
+        print_info(
+            f"Cache: {stats['cache_hit']} hits, {stats['cache_miss']} misses."
+        )
+    if stats["resumed"]:
+        print_info(f"Skipped {stats['resumed']} addresses finished in a previous run.")
+    retried = {k: stats[k] for k in RETRY_POLICIES if stats[k]}
+    if retried:
+        print_info(
+            "Retried failures: "
+            + ", ".join(f"{k}={v}" for k, v in sorted(retried.items()))
+            + "."
+        )
+    if stats["unresolved"]:
+        print_error(
+            f"Gave up on {stats['unresolved']} addresses after repeated errors."
+        )
+    if stats["skipped"]:
+        print_info(f"Skipped {stats['skipped']} addresses in unmanaged domains.")
+    saved = stats["duplicate"] + stats["malformed"]
+    if saved:
+        print_info(
+            f"Skipped {stats['duplicate']} duplicate and {stats['malformed']} "
+            + f"malformed addresses ({saved} requests saved)."
+        )
+
+
+def run():
+    # the event loop is chosen before main parses the arguments
+    loop_parser = argparse.ArgumentParser(add_help=False)
+    loop_parser.add_argument("--uvloop", action="store_true")
+    use_uvloop = loop_parser.parse_known_args()[0].uvloop
+    if use_uvloop and uvloop is None:
+        print_warning("uvloop is not installed (speedups extra), using asyncio.")
     try:
-        loop.run_until_complete(main())
+        if use_uvloop and uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         pass
+
+
+if __name__ == "__main__":
+    run()
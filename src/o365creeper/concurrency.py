@@ -0,0 +1,167 @@
+import asyncio
+from collections import deque
+from typing import Deque, List, Optional
+
+__all__ = ["AdaptiveLimiter", "FairShare"]
+
+
+class AdaptiveLimiter:
+    """Limit of requests in flight, adjusted with AIMD.
+
+    Outcomes are collected in windows of about ``limit`` responses (one
+    round trip for every slot). After a clean window the limit grows by
+    ``increase``; when the share of throttled responses exceeds
+    ``max_throttle`` or the mean latency exceeds ``latency_factor`` times
+    the best recent mean latency, it is multiplied by ``decrease``.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 1,
+        maximum: int = 100,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        max_throttle: float = 0.05,
+        latency_factor: float = 2.0,
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self._limit = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.max_throttle = max_throttle
+        self.latency_factor = latency_factor
+        self.inflight = 0
+        self.baseline: Optional[float] = None
+        self.last_throttle_ratio = 0.0
+        self.last_latency = 0.0
+        self._cond = asyncio.Condition()
+        self._count = 0
+        self._throttled = 0
+        self._latency_sum = 0.0
+        self._latency_count = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < self.limit)
+            self.inflight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.inflight -= 1
+            self._cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+    def record(self, throttled: bool, latency: Optional[float]):
+        """Account for one response and adjust the limit at the end of a window.
+
+        latency is None for a request that failed, whose time says nothing
+        about how fast the endpoint answers.
+        """
+        self._count += 1
+        self._throttled += throttled
+        if latency is not None:
+            self._latency_sum += latency
+            self._latency_count += 1
+        if self._count < max(10, self.limit):
+            return
+
+        ratio = self._throttled / self._count
+        self.last_throttle_ratio = ratio
+        slow = False
+        if self._latency_count:
+            mean = self._latency_sum / self._latency_count
+            self.last_latency = mean
+            slow = (
+                self.baseline is not None and mean > self.baseline * self.latency_factor
+            )
+            # the baseline creeps up slowly, so that a lasting change of the
+            # network does not keep the limit down forever
+            self.baseline = (
+                mean if self.baseline is None else min(mean, self.baseline * 1.01)
+            )
+        self._count = self._throttled = self._latency_count = 0
+        self._latency_sum = 0.0
+        if ratio > self.max_throttle or slow:
+            self._limit = max(self.minimum, self._limit * self.decrease)
+        else:
+            self._limit = min(self.maximum, self._limit + self.increase)
+
+
+class FairShare:
+    """Requests in flight shared fairly among jobs.
+
+    ``capacity`` slots are divided among the jobs from ``share``. A free
+    slot goes to the waiting job holding the fewest slots, so every busy
+    job gets an equal part of the capacity, up to its own ``cap``, and
+    what a job does not use goes to the others.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.used = 0
+        self._shares: List["_Share"] = []
+
+    def share(self, cap: Optional[int] = None) -> "_Share":
+        share = _Share(self, cap)
+        self._shares.append(share)
+        return share
+
+    def _dispatch(self):
+        while self.used < self.capacity:
+            waiting = [
+                s
+                for s in self._shares
+                if s._waiters and (s.cap is None or s.held < s.cap)
+            ]
+            if not waiting:
+                return
+            share = min(waiting, key=lambda s: s.held)
+            waiter = share._waiters.popleft()
+            if waiter.done():
+                continue
+            share.held += 1
+            self.used += 1
+            waiter.set_result(None)
+
+
+class _Share:
+    __slots__ = ("pool", "cap", "held", "_waiters")
+
+    def __init__(self, pool: FairShare, cap: Optional[int]):
+        self.pool = pool
+        self.cap = cap
+        self.held = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.pool._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # granted just as it was cancelled
+                self.release()
+            raise
+
+    def release(self):
+        self.held -= 1
+        self.pool.used -= 1
+        self.pool._dispatch()
+
+    def close(self):
+        """Stop taking part in the sharing, once every slot is released."""
+        self.pool._shares.remove(self)
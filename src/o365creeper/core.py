@@ -1,7 +1,10 @@
 import asyncio
 import random
 import re
-from typing import Dict
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Optional
 
 import aiohttp
 from aiohttp_socks import ProxyConnector
@@ -14,12 +17,72 @@ from o365creeper.utils import (
     print_warning,
 )
 from o365creeper.constants import UAS
+from o365creeper.jsonlib import dumps_bytes as json_dumps_bytes
+from o365creeper.jsonlib import loads as json_loads
+
+# IfExistsResult codes; 5 and 6 mean the account exists, with an external
+# identity provider or also as a personal account
+IF_EXISTS_RESULTS = {
+    -1: "unknown",
+    0: "exists",
+    1: "does not exist",
+    2: "throttled",
+    4: "error",
+    5: "exists (other identity provider)",
+    6: "exists (also personal account)",
+}
+VALID_CODES = (0, 5, 6)
+# codes that say whether the account exists; 2 is throttling, the others
+# are answers about nothing
+CONCLUSIVE_CODES = (0, 1, 5, 6)
+THROTTLED_CODE = 2
+
+_NAMESPACE_TYPE_RE = re.compile("<NameSpaceType>(\\w+)</NameSpaceType>")
+
+
+@dataclass(slots=True)
+class CheckResult:
+    """
+    Outcome of one GetCredentialType request
+    """
+
+    email: str
+    code: Optional[int] = None
+    throttle: bool = False
+    status: Optional[int] = None
+    elapsed: float = 0.0
+    error: Optional[Exception] = None
+
+    @property
+    def valid(self) -> bool:
+        return self.code in VALID_CODES
+
+    @property
+    def conclusive(self) -> bool:
+        """Whether the response says anything about the address."""
+        return (
+            self.error is None
+            and self.status == 200
+            and self.code in CONCLUSIVE_CODES
+            and not self.throttle
+        )
+
+    @property
+    def state(self) -> str:
+        if self.error is not None:
+            return "ERROR"
+        if self.throttle:
+            return "THROTTLED"
+        if not self.conclusive:
+            return "UNKNOWN"
+        return "VALID" if self.valid else "INVALID"
 
 
 async def verify_domain(
     domain: str,
     baseurl: str = "https://login.microsoftonline.com",
     tor_config=None,
+    capture=None,
     **kwargs,
 ) -> bool:
     if tor_config and tor_config["use"]:
@@ -28,15 +91,105 @@ async def verify_domain(
         )
         kwargs["connector"] = connector
     async with aiohttp.ClientSession(**kwargs) as session:
-        params = {"login": f"user@{domain}", "xml": 1}
-        url = baseurl + "/getuserrealm.srf"
+        return await get_realm(session, domain, baseurl, capture) == "Managed"
+
+
+def parse_realm(xml: str) -> str:
+    """
+    Return the namespace type of a getuserrealm.srf response
+    """
+    m = _NAMESPACE_TYPE_RE.search(xml)
+    return m.group(1) if m else "Unknown"
+
+
+async def get_realm(
+    session: aiohttp.ClientSession,
+    domain: str,
+    baseurl: str = "https://login.microsoftonline.com",
+    capture=None,
+) -> str:
+    """
+    Get the namespace type (Managed, Federated, Unknown) of a domain
+
+    The exchange is recorded by capture (a Capture) when given.
+    """
+    params = {"login": f"user@{domain}", "xml": 1}
+    url = baseurl + "/getuserrealm.srf"
+    start = time.perf_counter()
+    try:
         async with session.get(url, params=params) as resp:
             xml = await resp.text()
-            return re.search("<NameSpaceType>Managed</NameSpaceType>", xml) is not None
+    except Exception as e:
+        if capture is not None:
+            capture.realm(domain, url, None, None, None, time.perf_counter() - start, e)
+        raise
+    if capture is not None:
+        capture.realm(
+            domain,
+            url,
+            resp.status,
+            resp.headers,
+            xml.encode(),
+            time.perf_counter() - start,
+        )
+    return parse_realm(xml)
+
+
+def connection_tracer(stats: Counter) -> aiohttp.TraceConfig:
+    """
+    Count new and reused connections in stats["conn_new"] and stats["conn_reused"]
+    """
 
+    async def on_create(session, ctx, params):
+        stats["conn_new"] += 1
 
-async def need_retry(status: dict) -> bool:
-    return status["throttle"] or status["error"]
+    async def on_reuse(session, ctx, params):
+        stats["conn_reused"] += 1
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(on_create)
+    trace.on_connection_reuseconn.append(on_reuse)
+    return trace
+
+
+async def warm_up(
+    session: aiohttp.ClientSession, url: str, count: int, bucket=None
+):
+    """
+    Open up to count pooled connections to url before they are needed
+
+    Each connection costs a request, taken from bucket (a TokenBucket)
+    when given.
+    """
+
+    async def probe():
+        if bucket is not None:
+            await bucket.acquire()
+        try:
+            async with session.head(url) as resp:
+                await resp.read()
+        except Exception:
+            pass
+
+    await asyncio.gather(*(probe() for _ in range(count)))
+
+
+def parse_credential_type(ret: CheckResult, body: bytes):
+    """
+    Fill in ret from the body of a GetCredentialType response
+    """
+    try:
+        data = json_loads(body)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        code = data.get("IfExistsResult")
+        # bool is an int, but true is no code
+        if isinstance(code, int) and not isinstance(code, bool):
+            ret.code = code
+        ret.throttle = (
+            data.get("ThrottleStatus") == 1 or ret.code == THROTTLED_CODE
+        )
 
 
 async def check_email(
@@ -44,26 +197,38 @@ async def check_email(
     config: Dict,
     email: str,
     headers: Dict,
-):
+    capture=None,
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+) -> CheckResult:
     """
     Check if a given email exists at O365
+
+    The exchange is recorded by capture (a Capture) when given. timeout
+    overrides the timeouts of the session.
     """
-    ret = {}
     headers["User-Agent"] = random.choice(UAS)
-    payload = {"Username": email}
+    headers["Content-Type"] = "application/json"
+    # serialized by the JSON backend rather than by aiohttp with json
+    payload = json_dumps_bytes({"Username": email})
+    ret = CheckResult(email)
+    body = resp_headers = None
+    start = time.perf_counter()
     try:
         async with session.post(
-            config["url"], headers=headers, json=payload
+            config["url"],
+            headers=headers,
+            data=payload,
+            **({} if timeout is None else {"timeout": timeout}),
         ) as resp:
-            text = await resp.text()
-            ret["valid"] = re.search('"IfExistsResult":0,', text) is not None
-            ret["throttle"] = re.search('"ThrottleStatus":1,', text) is not None
-            ret["error"] = False
-            ret["exception"] = None
-    except BaseException as e:
-        ret["valid"] = False
-        ret["throttle"] = False
-        ret["error"] = True
-        ret["exception"] = e
+            ret.status = resp.status
+            resp_headers = resp.headers
+            body = await resp.read()
+        ret.elapsed = time.perf_counter() - start
+        parse_credential_type(ret, body)
+    except Exception as e:
+        ret.error = e
+        ret.elapsed = time.perf_counter() - start
+    if capture is not None:
+        capture.credential(ret, config["url"], headers, resp_headers, body)
 
     return ret
@@ -0,0 +1,237 @@
+import asyncio
+import itertools
+import os
+import stat
+import time
+from collections import Counter
+from contextlib import aclosing
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import aiohttp
+from aiohttp import web
+
+from o365creeper.enumerator import Enumerator
+from o365creeper.jsonlib import dumps as json_dumps
+from o365creeper.jsonlib import loads as json_loads
+from o365creeper.output import FIELDS, ResultRecord
+from o365creeper.utils import print_error, print_info
+
+__all__ = ["Daemon", "parse_address", "submit"]
+
+_RECORD_FIELDS = frozenset(FIELDS)
+
+
+def parse_address(address: str) -> Tuple[Optional[str], Optional[str], Optional[int]]:
+    """Split a daemon address into (socket path, host, port).
+
+    HOST:PORT is a TCP address, anything else the path of a Unix socket.
+    """
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return None, host or "127.0.0.1", int(port)
+    return address, None, None
+
+
+def _remove_stale_socket(path: str):
+    # only ever a socket, so that a mistyped address does not delete a file
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    os.unlink(path)
+
+
+class _Job:
+    __slots__ = ("id", "name", "started", "finished", "counts", "error")
+
+    def __init__(self, job_id: int, name: str):
+        self.id = job_id
+        self.name = name
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.counts = Counter()
+        self.error: Optional[str] = None
+
+    def summary(self) -> Dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "started": self.started,
+            "finished": self.finished,
+            "results": dict(self.counts),
+            "error": self.error,
+        }
+
+
+class Daemon:
+    """Serve enumeration jobs over HTTP, on a Unix socket or TCP.
+
+    The enumerator is started once, so its sessions, connection pools,
+    realm lookups and cache stay warm from one job to the next. Jobs run
+    concurrently and share its sessions and pacing:
+
+        POST /jobs[?name=NAME]: the body is a list of addresses, one per
+            line, which may still be streaming in; the response streams a
+            JSON line for each result as soon as it is final. Closing the
+            connection cancels the job.
+        GET /jobs: running and recently finished jobs
+        GET /stats: counters of the enumerator
+
+    There is no authentication: the Unix socket is only accessible to its
+    owner, and TCP should be bound to a loopback address.
+    """
+
+    def __init__(self, enumerator: Enumerator, keep: int = 100):
+        self.enumerator = enumerator
+        self.jobs: Dict[int, _Job] = {}
+        self.keep = keep
+        self._ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/jobs", self.run_job)
+        app.router.add_get("/jobs", self.list_jobs)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+    def _forget(self):
+        # keep only the last finished jobs
+        finished = [j for j in self.jobs.values() if j.finished is not None]
+        for job in finished[: max(0, len(finished) - self.keep)]:
+            del self.jobs[job.id]
+
+    async def run_job(self, request: web.Request) -> web.StreamResponse:
+        job_id = next(self._ids)
+        job = self.jobs[job_id] = _Job(job_id, request.query.get("name", f"job-{job_id}"))
+        print_info(f"Job {job.id} ({job.name}) started.")
+
+        async def addresses():
+            async for line in request.content:
+                line = line.decode(errors="replace").strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "application/x-ndjson", "X-Job-Id": str(job_id)}
+        )
+        await response.prepare(request)
+        try:
+            async with aclosing(self.enumerator.run(addresses())) as results:
+                async for record in results:
+                    job.counts[record.outcome.lower()] += 1
+                    await response.write(
+                        (
+                            json_dumps({f: getattr(record, f) for f in FIELDS}) + "\n"
+                        ).encode()
+                    )
+            await response.write_eof()
+        except ConnectionError:
+            # the client went away
+            job.error = "cancelled"
+        except asyncio.CancelledError:
+            job.error = "cancelled"
+            raise
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            print_error(f"Job {job.id} ({job.name}) failed: {job.error}")
+        finally:
+            job.finished = time.time()
+            print_info(
+                f"Job {job.id} ({job.name}) "
+                + ("finished" if job.error is None else job.error)
+                + ": "
+                + ", ".join(f"{k}={v}" for k, v in sorted(job.counts.items()))
+                + "."
+            )
+            self._forget()
+        return response
+
+    async def list_jobs(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            [j.summary() for j in self.jobs.values()], dumps=json_dumps
+        )
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.enumerator.stats), dumps=json_dumps)
+
+    async def serve(self, address: str):
+        """Serve at address until cancelled."""
+        path, host, port = parse_address(address)
+        runner = web.AppRunner(self.app(), handle_signals=False, access_log=None)
+        await runner.setup()
+        bound = False
+        try:
+            if path is not None:
+                _remove_stale_socket(path)
+                site = web.UnixSite(runner, path)
+                await site.start()
+                bound = True
+                os.chmod(path, 0o600)
+            else:
+                site = web.TCPSite(runner, host, port)
+                await site.start()
+            print_info(f"Serving jobs at {address}.")
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            if bound:
+                _remove_stale_socket(path)
+
+
+async def submit(
+    address: str,
+    addresses: Union[Iterable[str], AsyncIterable[str]],
+    name: Optional[str] = None,
+    chunk_size: int = 1000,
+) -> AsyncIterator[ResultRecord]:
+    """Run a job on the daemon at address, yielding its results.
+
+    Addresses are streamed to the daemon while results come back.
+    """
+    path, host, port = parse_address(address)
+    if path is not None:
+        connector = aiohttp.UnixConnector(path=path)
+        url = "http://localhost/jobs"
+    else:
+        connector = aiohttp.TCPConnector()
+        url = f"http://{host}:{port}/jobs"
+
+    async def body():
+        chunk = []
+        if isinstance(addresses, AsyncIterable):
+            async for a in addresses:
+                chunk.append(a + "\n")
+                if len(chunk) >= chunk_size:
+                    yield "".join(chunk).encode()
+                    chunk = []
+        else:
+            for a in addresses:
+                chunk.append(a + "\n")
+                if len(chunk) >= chunk_size:
+                    yield "".join(chunk).encode()
+                    chunk = []
+                    # reading the input may block, let the results flow meanwhile
+                    await asyncio.sleep(0)
+        if chunk:
+            yield "".join(chunk).encode()
+
+    params = {"name": name} if name else None
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async with session.post(url, data=body(), params=params) as resp:
+            resp.raise_for_status()
+            async for line in resp.content:
+                data = json_loads(line)
+                yield ResultRecord(
+                    **{k: v for k, v in data.items() if k in _RECORD_FIELDS}
+                )
@@ -0,0 +1,127 @@
+import hashlib
+import math
+import re
+from typing import Optional
+
+from o365creeper.utils import print_warning
+
+__all__ = [
+    "BloomFilter",
+    "Deduplicator",
+    "normalize_email",
+]
+
+# deliberately loose: we only want to weed out obvious garbage
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s.]+$")
+
+
+def normalize_email(address: str) -> Optional[str]:
+    """Normalize an email address.
+
+    Args:
+        address (str): Raw address
+
+    Returns:
+        Optional[str]: Lower-cased address without surrounding whitespace,
+        or None if it is not syntactically valid
+    """
+    address = address.strip().lower()
+    if _EMAIL_RE.match(address) is None:
+        return None
+    return address
+
+
+def _digest(item: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(item.encode(), digest_size=8).digest(), "little"
+    )
+
+
+class BloomFilter:
+    """Fixed-size probabilistic set.
+
+    Membership tests may return false positives at roughly ``error_rate``
+    once ``capacity`` items have been added, but never false negatives.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.count = 0
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        # double hashing (Kirsch-Mitzenmacher) from a single 128-bit digest
+        d = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(d[:8], "little")
+        h2 = int.from_bytes(d[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str) -> bool:
+        """Add item, returning True if it was (probably) already present."""
+        present = True
+        for pos in self._positions(item):
+            byte, bit = divmod(pos, 8)
+            if not self.bits[byte] & (1 << bit):
+                present = False
+                self.bits[byte] |= 1 << bit
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(item)
+        )
+
+
+class Deduplicator:
+    """Remember which addresses have already been seen.
+
+    Modes:
+        exact: set of 64-bit digests, a fraction of the memory of the strings
+        bloom: fixed-size Bloom filter for inputs too large for a set; a
+            small fraction of unique addresses may be mistaken for duplicates
+        off: no deduplication
+    """
+
+    MODES = ("exact", "bloom", "off")
+
+    def __init__(
+        self, mode: str = "exact", capacity: int = 10_000_000, error_rate: float = 0.001
+    ):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown deduplication mode: {mode}")
+        self.mode = mode
+        self._hashes = set()
+        self._bloom = BloomFilter(capacity, error_rate) if mode == "bloom" else None
+
+    def seen(self, item: str) -> bool:
+        """Record item, returning True if it was seen before."""
+        if self.mode == "off":
+            return False
+        if self._bloom is not None:
+            present = self._bloom.add(item)
+            if not present and self._bloom.count == self._bloom.capacity + 1:
+                print_warning(
+                    f"More than {self._bloom.capacity} unique addresses seen, "
+                    + "the Bloom filter will now drop a growing number of unique "
+                    + "addresses as duplicates. Raise --dedup-capacity."
+                )
+            return present
+        h = _digest(item)
+        if h in self._hashes:
+            return True
+        self._hashes.add(h)
+        return False
+
+    def __contains__(self, item: str) -> bool:
+        if self.mode == "off":
+            return False
+        if self._bloom is not None:
+            return item in self._bloom
+        return _digest(item) in self._hashes
+
@@ -0,0 +1,578 @@
+import asyncio
+import math
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Union,
+)
+
+import aiohttp
+
+from o365creeper.cache import ResultCache
+from o365creeper.capture import Capture
+from o365creeper.concurrency import AdaptiveLimiter, FairShare
+from o365creeper.core import check_email, connection_tracer, warm_up
+from o365creeper.dedup import Deduplicator, normalize_email
+from o365creeper.journal import FINAL_OUTCOMES, Journal, read_finished
+from o365creeper.metrics import Metrics
+from o365creeper.output import ResultRecord
+from o365creeper.pool import SessionPool
+from o365creeper.profiling import (
+    ADMIT,
+    OUTPUT,
+    PARSE,
+    QUEUE,
+    REQUEST,
+    SESSION,
+    LoopLag,
+    StageTimes,
+)
+from o365creeper.ratelimit import TokenBucket
+from o365creeper.realm import RealmResolver
+from o365creeper.retry import RetryScheduler, classify, describe, next_delay
+from o365creeper.timeouts import AdaptiveTimeout, client_timeout
+from o365creeper.tor import create_tor_session
+from o365creeper.utils import print_error
+
+__all__ = ["Enumerator", "EnumeratorConfig"]
+
+# marks the end of the results of a run
+_DONE = object()
+
+
+@dataclass
+class EnumeratorConfig:
+    """
+    Settings of an Enumerator, with the same defaults as the command line
+    """
+
+    baseurl: str = "https://login.microsoftonline.com"
+    headers: Dict[str, str] = field(default_factory=dict)
+    # seconds for the whole request, connecting and between reads (0: none)
+    timeout: float = 30
+    connect_timeout: float = 10
+    read_timeout: float = 20
+    # cut off reads after timeout_factor times the recent p99 latency
+    adaptive_timeout: bool = False
+    timeout_factor: float = 3.0
+    # retries of a failed address, see RETRY_POLICIES
+    retry: int = 3
+    # requests in flight, the upper bound when adaptive
+    maxworkers: int = 20
+    adaptive: bool = False
+    sleep: float = 0
+    # requests per second in total and through each session
+    rate: Optional[float] = None
+    burst: int = 1
+    session_rate: Optional[float] = None
+    sessions: int = 1
+    connection: str = "keep-alive"
+    keepalive: float = 30
+    warm_up: bool = False
+    # moving error rate at which a session is quarantined and rebuilt
+    session_max_errors: float = 0.5
+    # use tor_pool circuits of the Tor SOCKS proxy at socks_port as sessions
+    tor: bool = False
+    socks_port: int = 9050
+    tor_pool: int = 10
+    dedup: str = "exact"
+    dedup_capacity: int = 10_000_000
+    # record final outcomes, and skip those recorded already when resuming
+    journal: Optional[Path] = None
+    resume: bool = False
+    cache: Optional[Path] = None
+    cache_ttl: float = 7 * 24 * 3600
+    refresh: bool = False
+    # append every raw HTTP exchange to this file, see Capture
+    capture: Optional[Path] = None
+    # ask, skip or query addresses in unmanaged domains
+    unmanaged: str = "skip"
+    # collect Metrics, optionally streamed or exported while running
+    metrics: bool = False
+    metrics_interval: float = 5
+    metrics_stream: Optional[Path] = None
+    prometheus: Optional[Path] = None
+    # time every stage of every address and sample the event loop lag
+    stage_times: bool = False
+
+    def __post_init__(self):
+        self.baseurl = self.baseurl.strip("/")
+        if self.resume and self.journal is None:
+            raise ValueError("resume requires a journal")
+
+    @property
+    def url(self) -> str:
+        return self.baseurl + "/common/GetCredentialType"
+
+
+async def _iterate(addresses: Union[Iterable[str], AsyncIterable[str]]):
+    if isinstance(addresses, AsyncIterable):
+        async for address in addresses:
+            yield address
+    else:
+        for address in addresses:
+            yield address
+
+
+class Enumerator:
+    """Check email addresses against GetCredentialType.
+
+    Sessions, pacing, the cache, the journal and realm lookups are set up
+    by ``start`` and shared by every call to ``run``, which checks one
+    (async) iterable of addresses and yields a ResultRecord for each of
+    them as soon as it is final::
+
+        async with Enumerator(EnumeratorConfig(maxworkers=50)) as enumerator:
+            async for record in enumerator.run(addresses):
+                print(record.address, record.outcome)
+
+    Wrap ``run`` in ``contextlib.aclosing`` when it may be left early, so
+    that its workers are stopped right away.
+
+    Malformed, duplicate and (when resuming) already finished addresses are
+    dropped and only counted in ``stats``. ``on_retry`` is called with the
+    address, the failure kind and a reason whenever a check is retried.
+    """
+
+    def __init__(
+        self,
+        config: Optional[EnumeratorConfig] = None,
+        on_retry: Optional[Callable[[str, str, str], None]] = None,
+    ):
+        self.config = config or EnumeratorConfig()
+        self.on_retry = on_retry
+        self.stats = Counter()
+        self.pool: Optional[SessionPool] = None
+        self.limiter: Optional[AdaptiveLimiter] = None
+        self.read_timeout: Optional[AdaptiveTimeout] = None
+        self.metrics: Optional[Metrics] = None
+        self.stages: Optional[StageTimes] = None
+        self.loop_lag: Optional[LoopLag] = None
+        self.cache: Optional[ResultCache] = None
+        self.journal: Optional[Journal] = None
+        self.capture: Optional[Capture] = None
+        self.resolver: Optional[RealmResolver] = None
+        self._bucket: Optional[TokenBucket] = None
+        self._session_buckets: Dict[int, TokenBucket] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._started = False
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def start(self):
+        if self._started:
+            return
+        config = self.config
+        self._started = True
+
+        # files first, so that one that cannot be opened fails the start
+        # before any request is sent
+        if config.cache is not None:
+            self.cache = ResultCache(config.cache, config.cache_ttl)
+        if config.journal is not None:
+            self.journal = Journal(config.journal)
+            await self.journal.open()
+        if config.capture is not None:
+            self.capture = Capture(config.capture)
+            await self.capture.open()
+
+        # Sessions are shared by all workers, so each connector is sized to
+        # carry its share of the requests in flight.
+        session_count = max(1, config.tor_pool if config.tor else config.sessions)
+        conn_limit = math.ceil(max(1, config.maxworkers) / session_count)
+        # keep-alive pooling unless asked otherwise, and count handshakes
+        tracer = connection_tracer(self.stats)
+        if config.connection == "close":
+            connector_kwargs = {"force_close": True}
+        else:
+            connector_kwargs = {"keepalive_timeout": config.keepalive}
+
+        timeout = client_timeout(
+            config.timeout, config.connect_timeout, config.read_timeout
+        )
+        if config.adaptive_timeout:
+            self.read_timeout = AdaptiveTimeout(
+                config.timeout,
+                config.connect_timeout,
+                config.read_timeout or config.timeout or 60,
+                factor=config.timeout_factor,
+            )
+
+        def create_session(index: int, generation: int) -> aiohttp.ClientSession:
+            if config.tor:
+                return create_tor_session(
+                    config.socks_port,
+                    index,
+                    timeout,
+                    generation=generation,
+                    limit=conn_limit,
+                    connector_kwargs=connector_kwargs,
+                    trace_configs=[tracer],
+                )
+            return aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=conn_limit,
+                    limit_per_host=conn_limit,
+                    ttl_dns_cache=300,
+                    **connector_kwargs,
+                ),
+                timeout=timeout,
+                trace_configs=[tracer],
+            )
+
+        # pacing shared by all requests, and optionally per session
+        if config.rate:
+            self._bucket = TokenBucket(config.rate, config.burst)
+        if config.session_rate:
+            self._session_buckets = {
+                i: TokenBucket(config.session_rate, config.burst)
+                for i in range(session_count)
+            }
+
+        # Tor circuits exit through different addresses, so one being
+        # throttled says something about that circuit
+        self.pool = SessionPool(
+            create_session,
+            session_count,
+            config.baseurl,
+            max_error_rate=config.session_max_errors,
+            throttle_is_error=config.tor,
+            bucket=self._bucket,
+        )
+        await self.pool.start()
+        if config.warm_up and config.connection != "close":
+            await asyncio.gather(
+                *(
+                    warm_up(s, config.baseurl, conn_limit, self._bucket)
+                    for s in self.pool.sessions
+                )
+            )
+
+        if config.adaptive:
+            self.limiter = AdaptiveLimiter(
+                initial=max(1, config.maxworkers // 4), maximum=config.maxworkers
+            )
+
+        # realms are looked up as soon as a new domain is seen
+        self.resolver = RealmResolver(
+            lambda: self.pool.pick().session,
+            config.baseurl,
+            policy=config.unmanaged,
+            cache=self.cache,
+            capture=self.capture,
+            bucket=self._bucket,
+        )
+
+        if config.metrics:
+            self.metrics = Metrics(
+                self.stats,
+                interval=config.metrics_interval,
+                stream=config.metrics_stream,
+                prometheus=config.prometheus,
+            )
+            if self.limiter is not None:
+                self.metrics.gauge("concurrency_limit", lambda: self.limiter.limit)
+            self.metrics.gauge("healthy_sessions", lambda: self.pool.healthy)
+            if self.read_timeout is not None:
+                self.metrics.gauge("read_timeout", lambda: self.read_timeout.read)
+            self._tasks.append(asyncio.create_task(self.metrics.run()))
+        if config.stage_times:
+            self.stages = StageTimes()
+            self.loop_lag = LoopLag()
+            self._tasks.append(asyncio.create_task(self.loop_lag.run()))
+
+    async def stop(self):
+        """Release everything set up by start; runs should be finished."""
+        if not self._started:
+            return
+        self._started = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            if self.resolver is not None:
+                await self.resolver.close()
+            if self.journal is not None:
+                await self.journal.close()
+        finally:
+            try:
+                if self.capture is not None:
+                    await self.capture.close()
+            finally:
+                if self.cache is not None:
+                    self.cache.close()
+                if self.pool is not None:
+                    await self.pool.close()
+
+    async def _check(
+        self,
+        username: str,
+        attempt: int,
+        times: Optional[List[float]] = None,
+        bucket: Optional[TokenBucket] = None,
+        share: Optional[FairShare] = None,
+    ):
+        # one request for username, through the best session, once paced
+        if times is not None:
+            start = time.monotonic()
+        # the run's own rate, then its share of the requests in flight
+        if bucket is not None:
+            await bucket.acquire()
+        if share is not None:
+            await share.acquire()
+        try:
+            if self._bucket is not None:
+                await self._bucket.acquire()
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            entry = self.pool.acquire()
+            res = kind = None
+            try:
+                if self._session_buckets:
+                    await self._session_buckets[entry.index].acquire()
+                if self.metrics is not None:
+                    self.metrics.started()
+                if times is not None:
+                    sent = time.monotonic()
+                    times[SESSION] += sent - start
+                res = await check_email(
+                    session=entry.session,
+                    config={"url": self.config.url},
+                    email=username,
+                    headers=self.config.headers.copy(),
+                    capture=self.capture,
+                    timeout=(
+                        self.read_timeout.timeout
+                        if self.read_timeout is not None
+                        else None
+                    ),
+                )
+                # is endpoint throttling requests or some error occured?
+                kind = classify(res)
+                if self.read_timeout is not None and (
+                    res.error is None or kind == "timeout"
+                ):
+                    self.read_timeout.observe(res.elapsed, cut=kind == "timeout")
+                if times is not None:
+                    # elapsed ends once the body is read, parsing follows
+                    times[REQUEST] += res.elapsed
+                    times[PARSE] += max(0.0, time.monotonic() - sent - res.elapsed)
+            finally:
+                self.pool.release(entry, res, kind)
+                if self.limiter is not None:
+                    await self.limiter.release()
+        finally:
+            if share is not None:
+                share.release()
+        self.stats["requests"] += 1
+        if self.limiter is not None:
+            # a 429 is throttling as much as ThrottleStatus is
+            self.limiter.record(
+                kind in ("throttle", "http_429"),
+                res.elapsed if res.error is None else None,
+            )
+        if self.metrics is not None:
+            self.metrics.observe(res, entry.index, kind)
+        if self.config.sleep > 0:
+            await asyncio.sleep(self.config.sleep)
+        return entry, res, kind
+
+    async def run(
+        self,
+        addresses: Union[Iterable[str], AsyncIterable[str]],
+        workers: Optional[int] = None,
+        rate: Optional[float] = None,
+        share: Optional[FairShare] = None,
+    ) -> AsyncIterator[ResultRecord]:
+        """Check addresses, yielding a record for each as soon as it is final.
+
+        Records are yielded in completion order. An error raised while
+        reading addresses is raised once the addresses read so far are
+        finished. A record is only journaled once the consumer asks for
+        the next one, so that closing the iterator early does not mark
+        records that were never handled as finished.
+
+        Several runs may go on at once, sharing the sessions and pacing of
+        the enumerator. ``workers`` (default: maxworkers) and ``rate``
+        (requests per second, default: unlimited) then limit this run,
+        and requests wait for a slot of ``share``, if any, so that runs
+        get their fair part of the requests in flight.
+        """
+        await self.start()
+        config = self.config
+        stats = self.stats
+        resolver = self.resolver
+        cache = self.cache
+        stages = self.stages
+        workers = max(1, workers or config.maxworkers)
+        bucket = TokenBucket(rate, config.burst) if rate else None
+        # bounded, so that the input is only read as fast as it is consumed
+        queue = asyncio.Queue(maxsize=workers * 4)
+        results = asyncio.Queue(maxsize=workers * 4)
+        retries = RetryScheduler()
+        dedup = Deduplicator(config.dedup, config.dedup_capacity)
+        finished = read_finished(config.journal) if config.resume else None
+        input_error = None
+        if self.metrics is not None:
+            self.metrics.gauge("queue_depth", queue.qsize)
+            self.metrics.gauge("retry_pending", lambda: retries.pending)
+
+        async def drain():
+            # wait until every queued address, including retries, is
+            # finished and handed to the consumer
+            while True:
+                await queue.join()
+                if not retries.pending:
+                    break
+                await retries.join()
+            await results.join()
+
+        async def producer():
+            # Queue items are (address, failed attempts, time it was due,
+            # stage times or None).
+            nonlocal input_error
+            try:
+                async for raw in _iterate(addresses):
+                    username = normalize_email(raw)
+                    if username is None:
+                        stats["malformed"] += 1
+                        continue
+                    if dedup.seen(username):
+                        stats["duplicate"] += 1
+                        continue
+                    if finished is not None and username in finished:
+                        stats["resumed"] += 1
+                        continue
+                    domain = username.split(sep="@")[-1]
+                    resolver.prefetch(domain)
+                    await resolver.settle(domain, drain)
+                    await queue.put(
+                        (
+                            username,
+                            0,
+                            time.monotonic(),
+                            stages.new() if stages is not None else None,
+                        )
+                    )
+            except Exception as e:
+                input_error = e
+            await drain()
+            await results.put(_DONE)
+
+        async def finish(record: ResultRecord, times: Optional[List[float]]):
+            stats["done"] += 1
+            if record.outcome in FINAL_OUTCOMES:
+                stats[record.outcome.lower()] += 1
+            await results.put((record, times, time.monotonic()))
+
+        async def worker(worker_id: int):
+            while True:
+                username, attempt, due, times = await queue.get()
+                try:
+                    if times is not None:
+                        admitting = time.monotonic()
+                        times[QUEUE] += max(0.0, admitting - due)
+                    if attempt == 0:
+                        if not await resolver.admit(username.split(sep="@")[-1]):
+                            stats["skipped"] += 1
+                            await finish(
+                                ResultRecord(
+                                    username, "SKIPPED", reason="domain not managed"
+                                ),
+                                times,
+                            )
+                            continue
+
+                        if cache is not None and not config.refresh:
+                            outcome = cache.get(username, config.baseurl)
+                            if outcome is not None:
+                                stats["cache_hit"] += 1
+                                await finish(
+                                    ResultRecord(username, outcome, cached=True),
+                                    times,
+                                )
+                                continue
+                            stats["cache_miss"] += 1
+                        if times is not None:
+                            times[ADMIT] += time.monotonic() - admitting
+
+                    entry, res, kind = await self._check(
+                        username, attempt, times, bucket, share
+                    )
+                    record = ResultRecord(
+                        username,
+                        res.state,
+                        code=res.code,
+                        http_status=res.status,
+                        attempts=attempt + 1,
+                        latency_ms=round(res.elapsed * 1000, 1),
+                        session=entry.index,
+                    )
+                    if kind is None:
+                        if cache is not None:
+                            cache.put(username, res.state, config.baseurl)
+                        await finish(record, times)
+                        continue
+
+                    stats[kind] += 1
+                    reason = describe(res, kind)
+                    attempt += 1
+                    delay = next_delay(kind, attempt, config.retry)
+                    if delay is None:
+                        stats["unresolved"] += 1
+                        record.outcome = "UNRESOLVED"
+                        record.reason = f"{reason} (gave up after {attempt} attempts)"
+                        await finish(record, times)
+                    else:
+                        if self.on_retry is not None:
+                            self.on_retry(username, kind, reason)
+                        retries.schedule(
+                            (username, attempt, time.monotonic() + delay, times), delay
+                        )
+
+                except Exception as e:
+                    print_error(f"Worker {worker_id}: {e}")
+
+                finally:
+                    queue.task_done()
+
+        tasks = [asyncio.create_task(worker(i)) for i in range(workers)]
+        tasks.append(asyncio.create_task(retries.pump(queue)))
+        tasks.append(asyncio.create_task(producer()))
+        try:
+            while True:
+                item = await results.get()
+                if item is _DONE:
+                    break
+                record, times, finished_at = item
+                yield record
+                if times is not None:
+                    times[OUTPUT] = time.monotonic() - finished_at
+                    stages.record(times)
+                # the consumer is done with the record
+                if self.journal is not None and record.outcome in FINAL_OUTCOMES:
+                    self.journal.record(record.address, record.outcome)
+                results.task_done()
+            if input_error is not None:
+                raise input_error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if cache is not None:
+                cache.commit()
@@ -0,0 +1,86 @@
+import os
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from o365creeper.dedup import Deduplicator
+from o365creeper.writer import BatchedWriter
+
+__all__ = ["FINAL_OUTCOMES", "Journal", "read_finished", "read_journal"]
+
+# outcomes that will not change when the address is queried again
+FINAL_OUTCOMES = ("VALID", "INVALID")
+
+
+def read_journal(path: Path) -> Iterator[Tuple[str, str]]:
+    """Yield (address, outcome) pairs recorded in a journal.
+
+    A truncated last line, as left by a crash, is ignored.
+    """
+    try:
+        f = open(path, "r")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            outcome, _, address = line.rstrip("\n").partition("\t")
+            if address:
+                yield address, outcome
+
+
+def read_finished(path: Path) -> Deduplicator:
+    """Return the set of addresses with a final outcome in the journal at path."""
+    finished = Deduplicator("exact")
+    for address, outcome in read_journal(path):
+        if outcome in FINAL_OUTCOMES:
+            finished.seen(address)
+    return finished
+
+
+def _truncate_partial_line(path: Path):
+    # drop a last line left incomplete by a crash, so that new records do
+    # not get appended to it
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return
+    with f:
+        end = pos = f.seek(0, os.SEEK_END)
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            i = chunk.rfind(b"\n")
+            if i >= 0:
+                pos = pos - step + i + 1
+                break
+            pos -= step
+        if pos != end:
+            f.truncate(pos)
+
+
+class Journal(BatchedWriter):
+    """Append-only record of every finished address and its outcome.
+
+    Records are buffered and written in batches, either when ``batch_size``
+    records are pending or every ``interval`` seconds, and each batch is
+    fsync'd so a crash loses at most one interval of work. A failed write
+    is raised by the next call to ``record`` or ``close``.
+    """
+
+    async def _open(self):
+        _truncate_partial_line(self.path)
+        return open(self.path, "a")
+
+    def record(self, address: str, outcome: str):
+        self.check()
+        self._append(f"{outcome}\t{address}\n")
+
+    def _format(self, batch: List[str]) -> str:
+        return "".join(batch)
+
+    def _write(self, data: str):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
@@ -0,0 +1,25 @@
+"""JSON backend: orjson when installed (``speedups`` extra), else json."""
+
+import json
+
+__all__ = ["BACKEND", "dumps", "dumps_bytes", "loads"]
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+    loads = orjson.loads
+    dumps_bytes = orjson.dumps
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    BACKEND = "json"
+    loads = json.loads
+
+    def dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
+    def dumps_bytes(obj) -> bytes:
+        return dumps(obj).encode()
@@ -0,0 +1,266 @@
+import asyncio
+import math
+import os
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from o365creeper.core import CheckResult
+from o365creeper.jsonlib import dumps as json_dumps
+from o365creeper.retry import RETRY_POLICIES
+from o365creeper.utils import print_error
+
+__all__ = ["Histogram", "Metrics"]
+
+# upper bounds of the exported Prometheus latency buckets, in seconds
+PROMETHEUS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Log-bucketed histogram of positive values.
+
+    Buckets are ``growth`` times wider than the previous one, so quantiles
+    are exact within that relative error whatever the range of values.
+    """
+
+    def __init__(self, growth: float = 1.05):
+        self._log_growth = math.log(growth)
+        self.growth = growth
+        self.buckets: Counter = Counter()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.buckets[math.floor(math.log(max(value, 1e-6)) / self._log_growth)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.max, self.growth ** (index + 1))
+        return self.max
+
+    def cumulative(self, bounds) -> List[int]:
+        """Return the number of values at most each of bounds."""
+        counts = [0] * len(bounds)
+        for index, n in self.buckets.items():
+            upper = self.growth ** (index + 1)
+            for i, bound in enumerate(bounds):
+                if upper <= bound * self.growth:
+                    counts[i] += n
+        return counts
+
+    def summary(self, scale: float = 1.0) -> Dict:
+        def scaled(v):
+            return None if v is None else round(v * scale, 3)
+
+        return {
+            "count": self.count,
+            "mean": scaled(self.sum / self.count if self.count else None),
+            "p50": scaled(self.quantile(0.5)),
+            "p90": scaled(self.quantile(0.9)),
+            "p99": scaled(self.quantile(0.99)),
+            "max": scaled(self.max if self.count else None),
+        }
+
+
+class _SessionStats:
+    __slots__ = ("requests", "throttled", "errors", "latency")
+
+    def __init__(self):
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class Metrics:
+    """Instrumentation of a run.
+
+    Workers report every response with ``observe``; gauges such as queue
+    depths are registered as callables and read when sampling. Every
+    ``interval`` seconds ``run`` takes a sample of counters, rates and
+    gauges, which is kept for the summary, appended to a JSONL stream and
+    exported as a Prometheus textfile, if those paths are given.
+
+    Counters shared with the rest of the run (results, failure kinds,
+    connections) are read from ``stats``.
+    """
+
+    def __init__(
+        self,
+        stats: Counter,
+        interval: float = 5.0,
+        stream: Optional[Path] = None,
+        prometheus: Optional[Path] = None,
+    ):
+        self.stats = stats
+        self.interval = interval
+        self.stream = stream
+        self.prometheus = prometheus
+        self.start = time.time()
+        self.inflight = 0
+        self.latency = Histogram()
+        self.sessions: Dict[int, _SessionStats] = {}
+        self.samples: List[Dict] = []
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._window = Histogram()
+        self._last: Optional[Dict] = None
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        self._gauges[name] = read
+
+    def started(self):
+        self.inflight += 1
+
+    def observe(self, res: CheckResult, session: int, kind: Optional[str]):
+        """Account for one response, received through session."""
+        self.inflight -= 1
+        s = self.sessions.get(session)
+        if s is None:
+            s = self.sessions[session] = _SessionStats()
+        s.requests += 1
+        if kind == "throttle":
+            s.throttled += 1
+        elif kind is not None:
+            s.errors += 1
+        s.latency.record(res.elapsed)
+        self.latency.record(res.elapsed)
+        self._window.record(res.elapsed)
+
+    def _errors(self) -> int:
+        return sum(self.stats[k] for k in RETRY_POLICIES if k != "throttle")
+
+    def sample(self) -> Dict:
+        now = time.time()
+        sample = {
+            "time": round(now, 3),
+            "elapsed": round(now - self.start, 3),
+            "requests": self.stats["requests"],
+            "done": self.stats["done"],
+            "throttled": self.stats["throttle"],
+            "errors": self._errors(),
+            "inflight": self.inflight,
+        }
+        last = self._last or {"elapsed": 0.0, "requests": 0, "throttled": 0, "errors": 0}
+        span = sample["elapsed"] - last["elapsed"]
+        requests = sample["requests"] - last["requests"]
+        sample["req_rate"] = round(requests / span, 2) if span > 0 else 0.0
+        sample["throttle_rate"] = (
+            round((sample["throttled"] - last["throttled"]) / requests, 4)
+            if requests
+            else 0.0
+        )
+        sample["error_rate"] = (
+            round((sample["errors"] - last["errors"]) / requests, 4) if requests else 0.0
+        )
+        for name, read in self._gauges.items():
+            sample[name] = read()
+        sample["latency_ms"] = self._window.summary(1000)
+        self._window = Histogram()
+        self._last = sample
+        self.samples.append(sample)
+        return sample
+
+    def summary(self) -> Dict:
+        stats = self.stats
+        return {
+            "elapsed": round(time.time() - self.start, 3),
+            "requests": stats["requests"],
+            "results": {
+                k: stats[k] for k in ("valid", "invalid", "unresolved", "skipped")
+            },
+            "cache": {"hits": stats["cache_hit"], "misses": stats["cache_miss"]},
+            "failures": {k: stats[k] for k in RETRY_POLICIES},
+            "connections": {"new": stats["conn_new"], "reused": stats["conn_reused"]},
+            "latency_ms": self.latency.summary(1000),
+            "sessions": [
+                {
+                    "session": i,
+                    "requests": s.requests,
+                    "throttled": s.throttled,
+                    "errors": s.errors,
+                    "latency_ms": s.latency.summary(1000),
+                }
+                for i, s in sorted(self.sessions.items())
+            ],
+            "timeline": self.samples,
+        }
+
+    def write_summary(self, path: Path):
+        with open(path, "w") as f:
+            f.write(json_dumps(self.summary()) + "\n")
+
+    def prometheus_text(self) -> str:
+        stats = self.stats
+        lines = [
+            "# TYPE o365creeper_requests_total counter",
+            f"o365creeper_requests_total {stats['requests']}",
+            "# TYPE o365creeper_results_total counter",
+        ]
+        for outcome in ("valid", "invalid", "unresolved", "skipped"):
+            lines.append(
+                f'o365creeper_results_total{{outcome="{outcome}"}} {stats[outcome]}'
+            )
+        lines.append("# TYPE o365creeper_failures_total counter")
+        for kind in RETRY_POLICIES:
+            lines.append(f'o365creeper_failures_total{{kind="{kind}"}} {stats[kind]}')
+        lines.append("# TYPE o365creeper_inflight gauge")
+        lines.append(f"o365creeper_inflight {self.inflight}")
+        for name, read in self._gauges.items():
+            lines.append(f"# TYPE o365creeper_{name} gauge")
+            lines.append(f"o365creeper_{name} {read()}")
+
+        lines.append("# TYPE o365creeper_request_latency_seconds histogram")
+        counts = self.latency.cumulative(PROMETHEUS_BUCKETS)
+        for bound, n in zip(PROMETHEUS_BUCKETS, counts):
+            lines.append(f'o365creeper_request_latency_seconds_bucket{{le="{bound}"}} {n}')
+        lines.append(
+            'o365creeper_request_latency_seconds_bucket{le="+Inf"} '
+            + f"{self.latency.count}"
+        )
+        lines.append(f"o365creeper_request_latency_seconds_sum {self.latency.sum}")
+        lines.append(f"o365creeper_request_latency_seconds_count {self.latency.count}")
+
+        lines.append("# TYPE o365creeper_session_requests_total counter")
+        for i, s in sorted(self.sessions.items()):
+            lines.append(f'o365creeper_session_requests_total{{session="{i}"}} {s.requests}')
+        lines.append("# TYPE o365creeper_session_throttled_total counter")
+        for i, s in sorted(self.sessions.items()):
+            lines.append(
+                f'o365creeper_session_throttled_total{{session="{i}"}} {s.throttled}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def _export(self, sample: Dict):
+        try:
+            if self.stream is not None:
+                with open(self.stream, "a") as f:
+                    f.write(json_dumps(sample) + "\n")
+            if self.prometheus is not None:
+                # node_exporter may read the file at any time, replace it whole
+                tmp = self.prometheus.with_name(self.prometheus.name + ".tmp")
+                with open(tmp, "w") as f:
+                    f.write(self.prometheus_text())
+                os.replace(tmp, self.prometheus)
+        except OSError as e:
+            print_error(f"Error writing metrics: {e}")
+
+    async def run(self):
+        """Take a sample every interval until cancelled, and a last one then."""
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                self._export(self.sample())
+        finally:
+            self._export(self.sample())
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the MicrosoftOnline endpoints used by o365creeper, for
+# benchmarks and offline testing. Point the client at it with -u, e.g.
+#
+#   python -m o365creeper.mockserver --port 8765 --latency 50 --throttle 0.02
+#   o365creeper -f list.txt -u http://127.0.0.1:8765
+
+import argparse
+import asyncio
+import json
+import random
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import FrozenSet, Optional
+
+from aiohttp import web
+
+from o365creeper.utils import iter_lines, print_info
+
+__all__ = ["MockConfig", "create_app"]
+
+
+@dataclass
+class MockConfig:
+    """
+    Behaviour of the mock endpoints
+    """
+
+    # response time: fixed, uniform in [0, 2 * latency] or lognormal, in ms
+    latency: float = 50.0
+    distribution: str = "lognormal"
+    sigma: float = 0.5
+    # probability of a throttled response, and throttling of every request
+    # above this many in flight
+    throttle: float = 0.0
+    throttle_above: Optional[int] = None
+    # probabilities of injected errors
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    malformed_rate: float = 0.0
+    drop_rate: float = 0.0
+    # probability of a response stalling for stall more seconds
+    stall_rate: float = 0.0
+    stall: float = 30.0
+    # addresses that exist: listed ones and those starting with valid_prefix
+    valid: FrozenSet[str] = field(default_factory=frozenset)
+    valid_prefix: str = "valid"
+    # domains reported as Federated instead of Managed
+    federated: FrozenSet[str] = field(default_factory=frozenset)
+
+    DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+    def delay(self) -> float:
+        mean = self.latency / 1000
+        if self.distribution == "fixed" or mean <= 0:
+            return max(0.0, mean)
+        if self.distribution == "uniform":
+            return random.uniform(0, 2 * mean)
+        # lognormal, scaled so that its mean is the given latency
+        return mean * random.lognormvariate(-(self.sigma**2) / 2, self.sigma)
+
+
+def create_app(config: MockConfig) -> web.Application:
+    """Return an application serving GetCredentialType and getuserrealm.srf.
+
+    Request counts are kept in ``app["stats"]`` and served as JSON at
+    ``/_stats``.
+    """
+    stats = Counter()
+    inflight = 0
+
+    async def get_credential_type(request: web.Request) -> web.StreamResponse:
+        nonlocal inflight
+        inflight += 1
+        stats["requests"] += 1
+        try:
+            body = await request.json()
+            delay = config.delay()
+            if random.random() < config.stall_rate:
+                stats["stalled"] += 1
+                delay += config.stall
+            await asyncio.sleep(delay)
+            r = random.random()
+            if r < config.drop_rate:
+                stats["dropped"] += 1
+                request.transport.close()
+                return web.Response()
+            r -= config.drop_rate
+            if r < config.error_rate:
+                stats["errors"] += 1
+                return web.Response(status=500, text="<html>Internal error</html>")
+            r -= config.error_rate
+            if r < config.rate_limit_rate:
+                stats["rate_limited"] += 1
+                return web.Response(status=429, text="Too many requests")
+            r -= config.rate_limit_rate
+            if r < config.malformed_rate:
+                stats["malformed"] += 1
+                return web.Response(text="<html>Sign in</html>", content_type="text/html")
+
+            throttled = random.random() < config.throttle or (
+                config.throttle_above is not None and inflight > config.throttle_above
+            )
+            username = str(body.get("Username", ""))
+            valid = username.lower() in config.valid or username.lower().startswith(
+                config.valid_prefix
+            )
+            stats["throttled" if throttled else "valid" if valid else "invalid"] += 1
+            data = {
+                "Username": username,
+                "Display": username,
+                "IfExistsResult": 0 if valid and not throttled else 1,
+                "IsUnmanaged": False,
+                "ThrottleStatus": 1 if throttled else 0,
+                "Credentials": {"PrefCredential": 1, "HasPassword": True},
+            }
+            return web.Response(
+                text=json.dumps(data, separators=(",", ":")),
+                content_type="application/json",
+            )
+        finally:
+            inflight -= 1
+
+    async def get_user_realm(request: web.Request) -> web.Response:
+        stats["realm"] += 1
+        await asyncio.sleep(config.delay())
+        domain = request.query.get("login", "").rpartition("@")[2].lower()
+        namespace = "Federated" if domain in config.federated else "Managed"
+        return web.Response(
+            text=(
+                '<?xml version="1.0" ?><RealmInfo Success="true">'
+                + f"<State>4</State><UserState>1</UserState><Login>{domain}</Login>"
+                + f"<NameSpaceType>{namespace}</NameSpaceType>"
+                + f"<DomainName>{domain}</DomainName></RealmInfo>"
+            ),
+            content_type="text/xml",
+        )
+
+    async def head(request: web.Request) -> web.Response:
+        return web.Response()
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(dict(stats, inflight=inflight))
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_post("/common/GetCredentialType", get_credential_type)
+    app.router.add_get("/getuserrealm.srf", get_user_realm)
+    app.router.add_get("/_stats", get_stats)
+    app.router.add_route("HEAD", "/", head)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the MicrosoftOnline endpoints used by o365creeper."
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Address to listen on (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--port",
+        default=8765,
+        type=int,
+        help="Port to listen on (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--latency",
+        default=50,
+        type=float,
+        metavar="MS",
+        help="Mean response time in milliseconds (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--distribution",
+        choices=MockConfig.DISTRIBUTIONS,
+        default="lognormal",
+        help="Distribution of response times (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--sigma",
+        default=0.5,
+        type=float,
+        help="Shape of the lognormal distribution (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--throttle",
+        default=0,
+        type=float,
+        metavar="P",
+        help="Probability of a throttled response (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--throttle-above",
+        type=int,
+        metavar="N",
+        help="Throttle every request while more than %(metavar)s are in flight.",
+    )
+    parser.add_argument(
+        "--error-rate",
+        default=0,
+        type=float,
+        metavar="P",
+        help="Probability of an HTTP 500 response (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        default=0,
+        type=float,
+        metavar="P",
+        help="Probability of an HTTP 429 response (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--malformed-rate",
+        default=0,
+        type=float,
+        metavar="P",
+        help="Probability of an HTML body instead of JSON (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--drop-rate",
+        default=0,
+        type=float,
+        metavar="P",
+        help="Probability of closing the connection without answering (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--stall-rate",
+        default=0,
+        type=float,
+        metavar="P",
+        help="Probability of a response stalling for --stall seconds (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--stall",
+        default=30,
+        type=float,
+        metavar="TIME",
+        help="Extra response time of stalled responses (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--valid",
+        type=Path,
+        metavar="FILE",
+        help="Addresses listed in %(metavar)s exist.",
+    )
+    parser.add_argument(
+        "--valid-prefix",
+        default="valid",
+        metavar="PREFIX",
+        help="Addresses starting with %(metavar)s exist (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--federated",
+        action="append",
+        default=[],
+        metavar="DOMAIN",
+        help="Report %(metavar)s as federated (can be used multiple times).",
+    )
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        distribution=args.distribution,
+        sigma=args.sigma,
+        throttle=args.throttle,
+        throttle_above=args.throttle_above,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        malformed_rate=args.malformed_rate,
+        drop_rate=args.drop_rate,
+        stall_rate=args.stall_rate,
+        stall=args.stall,
+        valid=frozenset(
+            a.lower() for a in (iter_lines(args.valid) if args.valid else ())
+        ),
+        valid_prefix=args.valid_prefix.lower(),
+        federated=frozenset(d.lower() for d in args.federated),
+    )
+    print_info(f"Listening on http://{args.host}:{args.port}")
+    web.run_app(create_app(config), host=args.host, port=args.port, print=None)
+
+
+def run():
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,96 @@
+import csv
+import io
+import time
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import List, Optional
+
+from o365creeper.jsonlib import dumps as json_dumps
+from o365creeper.utils import is_new, open_output
+from o365creeper.writer import BatchedWriter
+
+__all__ = ["ResultRecord", "ResultWriter"]
+
+
+@dataclass(slots=True)
+class ResultRecord:
+    """
+    Final outcome of one address, as written to the output file
+    """
+
+    address: str
+    # VALID, INVALID, UNRESOLVED or SKIPPED
+    outcome: str
+    code: Optional[int] = None
+    http_status: Optional[int] = None
+    # number of requests sent, 0 for cached results
+    attempts: int = 0
+    latency_ms: Optional[float] = None
+    session: Optional[int] = None
+    cached: bool = False
+    reason: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+
+
+FIELDS = [f.name for f in fields(ResultRecord)]
+
+
+class ResultWriter(BatchedWriter):
+    """Buffered writer of result records.
+
+    Formats:
+        txt: one address per line
+        jsonl: one JSON object per record
+        csv: one row per record, with a header when the file is new
+
+    Records are buffered and written in batches, either when ``batch_size``
+    records are pending or every ``interval`` seconds, so that the event
+    loop hands one write per batch to a thread instead of one per record.
+    A failed write is raised by the next call to ``write`` or ``close``.
+    The path may be ``-`` for stdout, and is compressed by suffix, see
+    open_output.
+    """
+
+    FORMATS = ("txt", "jsonl", "csv")
+
+    def __init__(
+        self,
+        path: Path,
+        fmt: str = "txt",
+        interval: float = 1.0,
+        batch_size: int = 1000,
+    ):
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unknown output format: {fmt}")
+        super().__init__(path, interval, batch_size)
+        self.fmt = fmt
+
+    async def _open(self):
+        new = is_new(self.path)
+        f = open_output(self.path, newline="")
+        if self.fmt == "csv" and new:
+            csv.writer(f).writerow(FIELDS)
+        return f
+
+    def write(self, record: ResultRecord):
+        self.check()
+        self._append(record)
+
+    def _format(self, batch: List[ResultRecord]) -> str:
+        if self.fmt == "txt":
+            return "".join(r.address + "\n" for r in batch)
+        if self.fmt == "jsonl":
+            return "".join(
+                json_dumps({f: getattr(r, f) for f in FIELDS}) + "\n" for r in batch
+            )
+        out = io.StringIO()
+        writer = csv.writer(out)
+        for r in batch:
+            writer.writerow(
+                ["" if v is None else v for v in (getattr(r, f) for f in FIELDS)]
+            )
+        return out.getvalue()
+
+    def _write(self, data: str):
+        self._file.write(data)
+        self._file.flush()
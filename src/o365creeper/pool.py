@@ -0,0 +1,261 @@
+import asyncio
+import random
+import time
+from typing import Callable, Dict, List, Optional
+
+import aiohttp
+
+from o365creeper.core import CheckResult
+from o365creeper.ratelimit import TokenBucket
+from o365creeper.utils import print_error, print_info, print_warning
+
+__all__ = ["PooledSession", "SessionPool"]
+
+# failure kinds counted against the health of a session, see classify
+_FAILURES = ("connection", "timeout", "http_5xx", "parse")
+_THROTTLED = ("throttle", "http_429")
+
+
+class PooledSession:
+    """A session of a SessionPool and how it has been doing lately."""
+
+    __slots__ = (
+        "index",
+        "session",
+        "generation",
+        "healthy",
+        "inflight",
+        "latency",
+        "error_rate",
+        "recent",
+        "requests",
+        "errors",
+        "throttled",
+        "rebuilds",
+        "latency_sum",
+    )
+
+    def __init__(self, index: int, session: aiohttp.ClientSession, generation: int = 0):
+        self.index = index
+        self.session = session
+        self.generation = generation
+        self.healthy = True
+        self.inflight = 0
+        # moving averages, reset when the session is rebuilt
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.recent = 0
+        # totals over the run
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.rebuilds = 0
+        self.latency_sum = 0.0
+
+    def score(self) -> float:
+        # expected wait for one more request; untried sessions go first
+        return (self.latency or 0.0) * (self.inflight + 1)
+
+
+class SessionPool:
+    """Hand out sessions according to how they perform.
+
+    ``factory(index, generation)`` creates the session at index, again
+    with a higher generation when it is rebuilt (a Tor session then uses a
+    new circuit). On ``start`` every session is health-checked
+    concurrently with a HEAD request to ``probe_url``, and those failing
+    are rebuilt.
+
+    ``pick`` returns the better of two random healthy sessions, by moving
+    average of latency weighted by the requests in flight, so faster
+    sessions get more work without piling everything on one, except for
+    a share ``explore`` of picks, made at random to keep the latency of
+    every session up to date. Requests
+    sent through a session from ``acquire`` are accounted for with
+    ``release``. A session whose moving error
+    rate exceeds ``max_error_rate`` after at least ``min_requests`` is
+    quarantined and rebuilt in the background, unless it is the last
+    healthy one. Throttled responses only count as errors when
+    ``throttle_is_error``, for sessions that do not share an address.
+    Health checks count against ``bucket``, the rate limit of the run.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[int, int], aiohttp.ClientSession],
+        size: int,
+        probe_url: str,
+        probe_timeout: float = 10,
+        max_error_rate: float = 0.5,
+        min_requests: int = 10,
+        throttle_is_error: bool = False,
+        alpha: float = 0.1,
+        explore: float = 0.05,
+        bucket: Optional[TokenBucket] = None,
+    ):
+        self.factory = factory
+        self.size = max(1, size)
+        self.probe_url = probe_url
+        self.probe_timeout = probe_timeout
+        self.max_error_rate = max_error_rate
+        self.min_requests = min_requests
+        self.throttle_is_error = throttle_is_error
+        self.alpha = alpha
+        self.explore = explore
+        self.bucket = bucket
+        self.entries: List[PooledSession] = []
+        self._healthy: List[PooledSession] = []
+        self._rebuilding: Dict[int, asyncio.Task] = {}
+        self._closed = False
+
+    @property
+    def sessions(self) -> List[aiohttp.ClientSession]:
+        return [e.session for e in self.entries]
+
+    @property
+    def healthy(self) -> int:
+        return len(self._healthy)
+
+    async def start(self):
+        self.entries = [
+            PooledSession(i, self.factory(i, 0)) for i in range(self.size)
+        ]
+        self._healthy = list(self.entries)
+        results = await asyncio.gather(*(self.probe(e.session) for e in self.entries))
+        failed = [e for e, ok in zip(self.entries, results) if not ok]
+        if len(failed) == len(self.entries):
+            # nothing to fall back on, let the run find out
+            print_warning(f"No session passed its health check at {self.probe_url}.")
+            return
+        for entry in failed:
+            print_warning(f"Session {entry.index} failed its health check, rebuilding.")
+            self._quarantine(entry)
+
+    async def probe(self, session: aiohttp.ClientSession) -> bool:
+        if self.bucket is not None:
+            await self.bucket.acquire()
+        try:
+            async with session.head(
+                self.probe_url, timeout=aiohttp.ClientTimeout(total=self.probe_timeout)
+            ) as resp:
+                await resp.read()
+                return resp.status < 500
+        except Exception:
+            return False
+
+    def pick(self) -> PooledSession:
+        """Return the session to send the next request through."""
+        candidates = self._healthy or self.entries
+        if len(candidates) == 1:
+            return candidates[0]
+        if random.random() < self.explore:
+            # now and then any session, so that slow ones get a chance to recover
+            return random.choice(candidates)
+        a, b = random.sample(candidates, 2)
+        return a if a.score() <= b.score() else b
+
+    def acquire(self) -> PooledSession:
+        """Pick a session for a request to be accounted for with release."""
+        entry = self.pick()
+        entry.inflight += 1
+        return entry
+
+    def release(
+        self, entry: PooledSession, res: Optional[CheckResult], kind: Optional[str]
+    ):
+        """Account for the response to a request through entry."""
+        entry.inflight -= 1
+        if res is None or entry.session.closed:
+            # cancelled, or sent through a session rebuilt since
+            return
+        entry.requests += 1
+        entry.latency_sum += res.elapsed
+        alpha = self.alpha
+        if entry.latency is None:
+            entry.latency = res.elapsed
+        else:
+            entry.latency += alpha * (res.elapsed - entry.latency)
+        if kind in _THROTTLED:
+            entry.throttled += 1
+        failed = kind in _FAILURES or (kind in _THROTTLED and self.throttle_is_error)
+        if failed:
+            entry.errors += 1
+        entry.error_rate += alpha * (failed - entry.error_rate)
+        entry.recent += 1
+        if (
+            entry.healthy
+            and entry.recent >= self.min_requests
+            and entry.error_rate > self.max_error_rate
+            and len(self._healthy) > 1
+        ):
+            print_warning(
+                f"Session {entry.index} quarantined "
+                + f"({entry.error_rate:.0%} errors lately), rebuilding."
+            )
+            self._quarantine(entry)
+
+    def _quarantine(self, entry: PooledSession):
+        entry.healthy = False
+        self._healthy.remove(entry)
+        if not self._closed and entry.index not in self._rebuilding:
+            self._rebuilding[entry.index] = asyncio.create_task(self._rebuild(entry))
+
+    async def _rebuild(self, entry: PooledSession):
+        session = None
+        delay = 1.0
+        try:
+            # let the requests in flight finish before closing their session
+            deadline = time.monotonic() + self.probe_timeout
+            while entry.inflight and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            await entry.session.close()
+            while True:
+                entry.generation += 1
+                session = self.factory(entry.index, entry.generation)
+                if await self.probe(session):
+                    break
+                await session.close()
+                session = None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        except BaseException as e:
+            if session is not None:
+                await session.close()
+            if not isinstance(e, Exception):
+                raise
+            print_error(f"Error rebuilding session {entry.index}: {e}")
+            return
+        finally:
+            self._rebuilding.pop(entry.index, None)
+        entry.session = session
+        entry.rebuilds += 1
+        entry.latency = None
+        entry.error_rate = 0.0
+        entry.recent = 0
+        entry.healthy = True
+        self._healthy.append(entry)
+        print_info(f"Session {entry.index} rebuilt.")
+
+    async def close(self):
+        self._closed = True
+        tasks = list(self._rebuilding.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(e.session.close() for e in self.entries))
+
+    def summary(self) -> List[Dict]:
+        return [
+            {
+                "session": e.index,
+                "healthy": e.healthy,
+                "requests": e.requests,
+                "errors": e.errors,
+                "throttled": e.throttled,
+                "rebuilds": e.rebuilds,
+                "mean_latency_ms": (
+                    round(e.latency_sum / e.requests * 1000, 1) if e.requests else None
+                ),
+            }
+            for e in self.entries
+        ]
@@ -0,0 +1,133 @@
+"""Profiling of runs: per-stage wall time, event loop lag and a profiler.
+
+The profiler is yappi, which follows coroutines across awaits, when it is
+installed (``profile`` extra), else cProfile.
+"""
+
+import asyncio
+import cProfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from o365creeper.jsonlib import BACKEND as JSON_BACKEND
+from o365creeper.jsonlib import dumps as json_dumps
+from o365creeper.metrics import Histogram
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+__all__ = ["PROFILER", "STAGES", "LoopLag", "StageTimes", "profile"]
+
+PROFILER = "cProfile" if yappi is None else "yappi"
+
+# where the time of an address goes, from the moment it is queued:
+#   queue: waiting in the work queue for a worker (retries: once due)
+#   admit: realm decision and cache lookup
+#   session: pacing, concurrency limit and per-session rate
+#   request: sending the request and reading the response
+#   parse: parsing and classifying the response
+#   output: handing the record to the consumer, and the consumer
+STAGES = ("queue", "admit", "session", "request", "parse", "output")
+QUEUE, ADMIT, SESSION, REQUEST, PARSE, OUTPUT = range(len(STAGES))
+
+
+class StageTimes:
+    """Wall time spent by addresses in each stage of a run.
+
+    Workers carry a list from ``new`` along with each address, adding the
+    seconds spent in every stage over all its attempts, and ``record`` it
+    once the address is finished. Each stage gets a histogram of the time
+    per address, so that the saturated stage stands out: long queue waits
+    mean too few workers, session waits a pacing limit, output waits a
+    slow consumer.
+    """
+
+    def __init__(self):
+        self.stages = {name: Histogram() for name in STAGES}
+        self.total = Histogram()
+
+    @staticmethod
+    def new() -> List[float]:
+        return [0.0] * len(STAGES)
+
+    def record(self, times: List[float]):
+        for name, seconds in zip(STAGES, times):
+            self.stages[name].record(seconds)
+        self.total.record(sum(times))
+
+    def summary(self) -> Dict:
+        total = sum(h.sum for h in self.stages.values())
+        return {
+            "addresses": self.total.count,
+            "stages": {
+                name: {
+                    "seconds": round(h.sum, 3),
+                    "share": round(h.sum / total, 4) if total else 0.0,
+                    "ms": h.summary(1000),
+                }
+                for name, h in self.stages.items()
+            },
+            "total_ms": self.total.summary(1000),
+        }
+
+
+class LoopLag:
+    """Sample how late the event loop runs a callback due every interval.
+
+    A busy loop delays every timer and every response read by that much,
+    so a high lag means the process itself is the bottleneck.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.lag = Histogram()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            due = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag.record(max(0.0, loop.time() - due))
+
+    def summary(self) -> Dict:
+        return {"interval_ms": self.interval * 1000, "ms": self.lag.summary(1000)}
+
+
+def write_summary(
+    path: Path, stages: Optional[StageTimes], lag: Optional[LoopLag]
+):
+    loop = type(asyncio.get_running_loop()).__module__.partition(".")[0]
+    summary = {"profiler": PROFILER, "loop": loop, "json": JSON_BACKEND}
+    if stages is not None:
+        summary.update(stages.summary())
+    if lag is not None:
+        summary["loop_lag"] = lag.summary()
+    with open(path, "w") as f:
+        f.write(json_dumps(summary) + "\n")
+
+
+@contextmanager
+def profile(path: Path):
+    """Profile the block, in wall time, and write pstats data to path."""
+    if yappi is not None:
+        yappi.set_clock_type("wall")
+        yappi.start()
+        try:
+            yield
+        finally:
+            yappi.stop()
+            yappi.get_func_stats().save(str(path), type="pstat")
+            yappi.clear_stats()
+        return
+
+    profiler = cProfile.Profile(time.perf_counter)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
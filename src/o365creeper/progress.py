@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import Counter, deque
+from datetime import timedelta
+from typing import Optional, TextIO
+
+from o365creeper.retry import RETRY_POLICIES
+
+__all__ = ["StatusLine"]
+
+_CLEAR = "\r\x1b[K"
+
+
+class StatusLine:
+    """Single refreshing line summarizing the progress of a run.
+
+    It is drawn every ``interval`` seconds from the counters in ``stats``,
+    which the workers bump as they go: ``done``, ``valid``, ``invalid``,
+    ``requests`` and the failure kinds of RETRY_POLICIES. Rates are taken
+    over the last ``window`` seconds. When the stream is not a terminal, a
+    plain line is written every ``interval`` seconds instead.
+
+    Log messages clear the line before being written, so that they do not
+    end up on the same line; it is drawn again at the next refresh.
+    """
+
+    def __init__(
+        self,
+        stats: Counter,
+        total: Optional[int] = None,
+        interval: float = 1.0,
+        window: float = 10.0,
+        stream: TextIO = sys.stderr,
+    ):
+        self.stats = stats
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.tty = stream.isatty()
+        self._samples = deque(maxlen=max(2, int(window / interval) + 1))
+        self._shown = False
+        self._filter = self._clear_before_log
+
+    def _clear_before_log(self, record: logging.LogRecord) -> bool:
+        self.clear()
+        return True
+
+    def clear(self):
+        if self._shown:
+            self.stream.write(_CLEAR)
+            self.stream.flush()
+            self._shown = False
+
+    def render(self) -> str:
+        stats = self.stats
+        now = time.monotonic()
+        self._samples.append((now, stats["done"], stats["requests"]))
+        t0, done0, requests0 = self._samples[0]
+        elapsed = now - t0
+        req_rate = (stats["requests"] - requests0) / elapsed if elapsed else 0.0
+        done_rate = (stats["done"] - done0) / elapsed if elapsed else 0.0
+
+        if self.total:
+            progress = f"{stats['done']}/{self.total} ({stats['done'] / self.total:.0%})"
+        else:
+            progress = f"{stats['done']}/?"
+        eta = "?"
+        if self.total and done_rate > 0:
+            left = max(0, self.total - stats["done"]) / done_rate
+            eta = str(timedelta(seconds=round(left)))
+        errors = sum(stats[k] for k in RETRY_POLICIES if k != "throttle")
+        return (
+            f"[~] {progress} | valid {stats['valid']} | invalid {stats['invalid']}"
+            + f" | throttled {stats['throttle']} | errors {errors}"
+            + f" | {req_rate:.0f} req/s | ETA {eta}"
+        )
+
+    def draw(self):
+        line = self.render()
+        if self.tty:
+            self.stream.write(_CLEAR + line)
+            self._shown = True
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    async def run(self):
+        """Refresh the line until cancelled."""
+        handlers = logging.getLogger().handlers
+        for h in handlers:
+            h.addFilter(self._filter)
+        try:
+            while True:
+                self.draw()
+                await asyncio.sleep(self.interval)
+        finally:
+            for h in handlers:
+                h.removeFilter(self._filter)
+            self.draw()
+            if self.tty:
+                self.stream.write("\n")
+                self.stream.flush()
+                self._shown = False
@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+__all__ = ["TokenBucket"]
+
+
+class TokenBucket:
+    """Token-bucket rate limiter shared by any number of tasks.
+
+    Allows ``rate`` acquisitions per second on average and bursts of up to
+    ``burst``. Waiters are served in FIFO order.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # holding the lock while sleeping keeps waiters in order
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
@@ -0,0 +1,182 @@
+import asyncio
+import sys
+import threading
+from typing import Awaitable, Callable, Dict, Optional
+
+import aiohttp
+from colorama import Fore
+
+from o365creeper.cache import ResultCache
+from o365creeper.core import get_realm
+from o365creeper.ratelimit import TokenBucket
+from o365creeper.utils import print_error, print_warning
+
+__all__ = ["RealmResolver"]
+
+
+def _ask(domain: str, realm: str) -> bool:
+    while True:
+        c = (
+            input(
+                f"{Fore.YELLOW} Domain {domain} is NOT MANAGED ({realm}) "
+                + "by MicrosoftOnline. Trying to enumerate may lead to"
+                + f" unexpected results.{Fore.RESET} "
+                + "Do you wish to enumerate its addresses? [y/N] "
+            )
+            or "N"
+        )
+        if c.upper() in ("Y", "N"):
+            return c.upper() == "Y"
+
+
+async def _prompt(domain: str, realm: str) -> bool:
+    # input() runs in a daemon thread rather than the default executor, so
+    # that a pending prompt does not hold up shutdown on Ctrl-C
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def resolve(method, value):
+        if not fut.done():
+            method(value)
+
+    def target():
+        try:
+            answer = _ask(domain, realm)
+        except Exception as e:
+            loop.call_soon_threadsafe(resolve, fut.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(resolve, fut.set_result, answer)
+
+    threading.Thread(target=target, daemon=True).start()
+    return await fut
+
+
+class RealmResolver:
+    """Resolve and memoize the realm of every domain seen in the input.
+
+    Lookups run concurrently through the shared sessions and each domain is
+    looked up at most once per run (and once per cache TTL when a cache is
+    given). Addresses in domains that are not managed by MicrosoftOnline are
+    handled according to ``policy``:
+
+        ask: prompt once per domain whether to enumerate it (skip when stdin
+            is not a terminal)
+        skip: do not query them
+        query: query them anyway, with a warning
+
+    Domains whose realm cannot be looked up are queried, with an error.
+
+    Lookups count against ``bucket``, the rate limit of the run, if any,
+    and at most ``concurrency`` of them are in flight at once.
+    """
+
+    POLICIES = ("ask", "skip", "query")
+
+    def __init__(
+        self,
+        get_session: Callable[[], aiohttp.ClientSession],
+        baseurl: str,
+        policy: str = "ask",
+        cache: Optional[ResultCache] = None,
+        attempts: int = 3,
+        capture=None,
+        bucket: Optional[TokenBucket] = None,
+        concurrency: int = 8,
+    ):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown realm policy: {policy}")
+        if policy == "ask" and not sys.stdin.isatty():
+            policy = "skip"
+        self.get_session = get_session
+        self.baseurl = baseurl
+        self.policy = policy
+        self.cache = cache
+        self.attempts = max(1, attempts)
+        self.capture = capture
+        self.bucket = bucket
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._realms: Dict[str, asyncio.Task] = {}
+        self._decisions: Dict[str, asyncio.Task] = {}
+
+    def prefetch(self, domain: str):
+        """Start looking up domain in the background, if not done already."""
+        if domain not in self._realms:
+            self._realms[domain] = asyncio.create_task(self._lookup(domain))
+
+    async def realm(self, domain: str) -> Optional[str]:
+        """Return the realm of domain, or None if it could not be looked up."""
+        self.prefetch(domain)
+        return await asyncio.shield(self._realms[domain])
+
+    async def settle(self, domain: str, drain: Callable[[], Awaitable]):
+        """Make the decision for domain before any of its addresses is queued.
+
+        When the decision needs a prompt, ``drain`` is awaited first so that
+        the prompt is not interleaved with results of other domains.
+        """
+        if self.policy != "ask" or domain in self._decisions:
+            return
+        realm = await self.realm(domain)
+        if realm is not None and realm != "Managed":
+            await drain()
+        await self.admit(domain)
+
+    async def admit(self, domain: str) -> bool:
+        """Return whether addresses of domain should be queried."""
+        if domain not in self._decisions:
+            self._decisions[domain] = asyncio.create_task(self._decide(domain))
+        return await asyncio.shield(self._decisions[domain])
+
+    async def _lookup(self, domain: str) -> Optional[str]:
+        if self.cache is not None:
+            realm = self.cache.get_realm(domain, self.baseurl)
+            if realm is not None:
+                return realm
+        for attempt in range(self.attempts):
+            try:
+                async with self._slots:
+                    if self.bucket is not None:
+                        await self.bucket.acquire()
+                    realm = await get_realm(
+                        self.get_session(), domain, self.baseurl, self.capture
+                    )
+                break
+            except Exception as e:
+                error = e
+                if attempt + 1 < self.attempts:
+                    await asyncio.sleep(2**attempt)
+        else:
+            print_error(f"Could not get realm of {domain}: {error}")
+            return None
+        if self.cache is not None:
+            self.cache.put_realm(domain, realm, self.baseurl)
+        return realm
+
+    async def _decide(self, domain: str) -> bool:
+        realm = await self.realm(domain)
+        if realm is None:
+            print_error(
+                f"Realm of domain {domain} is unknown, querying its addresses anyway."
+            )
+            return True
+        if realm == "Managed":
+            return True
+        if self.policy == "query":
+            print_warning(
+                f"Domain {domain} is NOT MANAGED ({realm}) by MicrosoftOnline."
+                + " Results may be unreliable."
+            )
+            return True
+        if self.policy == "skip":
+            print_warning(
+                f"Domain {domain} is NOT MANAGED ({realm}) by MicrosoftOnline."
+                + " Skipping its addresses."
+            )
+            return False
+        return await _prompt(domain, realm)
+
+    async def close(self):
+        tasks = [*self._realms.values(), *self._decisions.values()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
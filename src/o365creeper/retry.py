@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from o365creeper.core import IF_EXISTS_RESULTS, CheckResult
+
+__all__ = [
+    "RETRY_POLICIES",
+    "RetryPolicy",
+    "RetryScheduler",
+    "classify",
+    "describe",
+    "next_delay",
+]
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How to retry one kind of failure.
+
+    The n-th retry waits a random time between 0 and
+    ``min(cap, base * 2**n)`` seconds (exponential backoff, full jitter).
+    ``max_retries`` overrides the global retry limit when it is lower.
+    """
+
+    base: float
+    cap: float
+    max_retries: Optional[int] = None
+
+
+RETRY_POLICIES: Dict[str, RetryPolicy] = {
+    # another session (Tor circuit) may not be throttled, try again soon
+    "throttle": RetryPolicy(base=1.0, cap=60.0),
+    "http_429": RetryPolicy(base=5.0, cap=120.0),
+    "http_5xx": RetryPolicy(base=1.0, cap=30.0),
+    "timeout": RetryPolicy(base=1.0, cap=30.0),
+    "connection": RetryPolicy(base=0.5, cap=15.0),
+    # an IfExistsResult saying nothing about the address, such as 4 (error)
+    "result_code": RetryPolicy(base=1.0, cap=30.0),
+    # an unexpected body is unlikely to fix itself
+    "parse": RetryPolicy(base=1.0, cap=5.0, max_retries=1),
+}
+
+
+def classify(res: CheckResult) -> Optional[str]:
+    """Return the kind of failure of a check_email result, or None on success."""
+    if res.error is not None:
+        if isinstance(res.error, asyncio.TimeoutError):
+            return "timeout"
+        return "connection"
+    if res.throttle:
+        return "throttle"
+    if res.status == 429:
+        return "http_429"
+    if res.status is not None and res.status >= 500:
+        return "http_5xx"
+    if res.status == 200 and res.code is not None and not res.conclusive:
+        return "result_code"
+    if not res.conclusive:
+        return "parse"
+    return None
+
+
+def describe(res: CheckResult, kind: str) -> str:
+    """Return a short human-readable reason for a failed result."""
+    if kind == "throttle":
+        return "THROTTLED"
+    if kind in ("http_429", "http_5xx"):
+        return f"HTTP {res.status}"
+    if kind == "result_code":
+        return (
+            f"IfExistsResult={res.code} "
+            + f"({IF_EXISTS_RESULTS.get(res.code, 'unknown')})"
+        )
+    if kind == "parse":
+        return f"unexpected response (HTTP {res.status})"
+    return str(res.error) or type(res.error).__name__
+
+
+def next_delay(kind: str, attempt: int, max_retries: int) -> Optional[float]:
+    """Return how long to wait before retrying after ``attempt`` failures.
+
+    Returns None once the address has used up its retries.
+    """
+    policy = RETRY_POLICIES[kind]
+    if policy.max_retries is not None:
+        max_retries = min(max_retries, policy.max_retries)
+    if attempt > max_retries:
+        return None
+    return random.uniform(0, min(policy.cap, policy.base * 2 ** (attempt - 1)))
+
+
+class RetryScheduler:
+    """Time-ordered delay queue feeding retries back into the work queue.
+
+    Items are kept in a heap until they are due, then moved to the work
+    queue by ``pump``, so waiting for a retry never occupies a worker.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def pending(self) -> int:
+        """Number of items scheduled and not yet in the work queue."""
+        return self._pending
+
+    def schedule(self, item: Any, delay: float):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), item))
+        self._pending += 1
+        self._idle.clear()
+        self._wake.set()
+
+    async def _pop_due(self) -> Any:
+        while True:
+            self._wake.clear()
+            if self._heap:
+                delay = self._heap[0][0] - time.monotonic()
+                if delay <= 0:
+                    return heapq.heappop(self._heap)[2]
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._wake.wait()
+
+    async def pump(self, queue: asyncio.Queue):
+        """Move due items to queue, forever."""
+        while True:
+            item = await self._pop_due()
+            await queue.put(item)
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.set()
+
+    async def join(self):
+        """Wait until every scheduled item has been moved to the work queue."""
+        await self._idle.wait()
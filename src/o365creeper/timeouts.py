@@ -0,0 +1,91 @@
+from collections import deque
+from typing import Deque, Optional
+
+import aiohttp
+
+__all__ = ["AdaptiveTimeout", "client_timeout"]
+
+
+def client_timeout(
+    total: Optional[float], connect: Optional[float], read: Optional[float]
+) -> aiohttp.ClientTimeout:
+    """Return the timeouts of a request, by phase, in seconds (0: none).
+
+    Args:
+        total (float): The whole request, from the wait for a connection
+            to the end of the body
+        connect (float): Connecting, including the SOCKS negotiation and
+            the TLS handshake, but not the wait for a pooled connection
+        read (float): Between two reads of the response, so mostly the
+            wait for the first byte for these short responses
+
+    Returns:
+        aiohttp.ClientTimeout: Timeouts to give to a session or request
+    """
+    return aiohttp.ClientTimeout(
+        total=total or None, sock_connect=connect or None, sock_read=read or None
+    )
+
+
+class AdaptiveTimeout:
+    """Read timeout following the latency of recent responses.
+
+    The timeout is ``factor`` times the ``quantile`` of the time taken by
+    the last ``window`` responses, between ``minimum`` and ``maximum``, so
+    that a stalled request is cut off and retried after a few times what
+    the slowest normal ones take, while a slow but steady endpoint keeps
+    getting answers. Should more than ``max_cut`` of the requests since
+    the last update be cut off, the endpoint rather got slower and the
+    timeout is doubled. ``maximum`` is used until ``min_samples``
+    responses are known, and the timeout is updated every ``every``
+    requests.
+    """
+
+    def __init__(
+        self,
+        total: Optional[float],
+        connect: Optional[float],
+        maximum: float,
+        minimum: float = 1.0,
+        factor: float = 3.0,
+        quantile: float = 0.99,
+        max_cut: float = 0.05,
+        window: int = 1000,
+        min_samples: int = 100,
+        every: int = 50,
+    ):
+        self.total = total
+        self.connect = connect
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.factor = factor
+        self.quantile = quantile
+        self.max_cut = max_cut
+        self.min_samples = min_samples
+        self.every = every
+        self.samples: Deque[float] = deque(maxlen=window)
+        self._observed = 0
+        self._cut = 0
+        self.read = maximum
+        self.timeout = client_timeout(total, connect, maximum)
+
+    def observe(self, elapsed: float, cut: bool = False):
+        """Account for a response after elapsed seconds, or a request cut off."""
+        if cut:
+            self._cut += 1
+        else:
+            self.samples.append(elapsed)
+        self._observed += 1
+        if self._observed < self.every or len(self.samples) < self.min_samples:
+            return
+        if self._cut > self.max_cut * self._observed:
+            read = self.read * 2
+        else:
+            ordered = sorted(self.samples)
+            latency = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+            read = latency * self.factor
+        self._observed = self._cut = 0
+        read = round(min(self.maximum, max(self.minimum, read)), 2)
+        if read != self.read:
+            self.read = read
+            self.timeout = client_timeout(self.total, self.connect, read)
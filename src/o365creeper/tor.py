@@ -1,3 +1,4 @@
+import asyncio
 import aiohttp
 from o365creeper.utils import print_error, print_success
 from aiohttp_socks import ProxyConnector, ProxyType
@@ -22,43 +23,65 @@ async def test_tor(socks_port: int):
             raise Exception("Unexpected response from Tor check page: " + text)
 
 
+def _circuit_connector(socks_port: int, name: str, **kwargs) -> ProxyConnector:
+    # Tor isolates streams by SOCKS credentials, so each name gets its own circuit
+    return ProxyConnector(
+        host="127.0.0.1",
+        port=socks_port,
+        proxy_type=ProxyType.SOCKS5,
+        rdns=True,
+        username=name,
+        password="password",
+        **kwargs,
+    )
+
+
 async def test_circuits(socks_port: int, count: int):
     test_url = "https://api.ipify.org"
+    timeout = aiohttp.ClientTimeout(total=30)
     # get max number of digits in count
     digits = len(str(count))
-    for i in range(count):
-        connector = ProxyConnector(
-            host="127.0.0.1",
-            port=socks_port,
-            proxy_type=ProxyType.SOCKS5,
-            rdns=True,
-            username=f"tor{i}",
-            password="password",
-        )
-        async with aiohttp.request(
-            method="GET", url=test_url, connector=connector
-        ) as resp:
-            text = await resp.text()
-            if resp.status != 200:
-                print_error(f"Tor circuit {i+1:>{digits}}: failed with status {resp.status}")
-            else:
-                print_success(f"Tor circuit {i+1:>{digits}}: {text.strip()}")
-        await connector.close()
 
+    async def test(i: int):
+        connector = _circuit_connector(socks_port, f"tor{i}")
+        try:
+            async with aiohttp.request(
+                method="GET", url=test_url, connector=connector, timeout=timeout
+            ) as resp:
+                text = await resp.text()
+                if resp.status != 200:
+                    print_error(
+                        f"Tor circuit {i+1:>{digits}}: failed with status {resp.status}"
+                    )
+                else:
+                    print_success(f"Tor circuit {i+1:>{digits}}: {text.strip()}")
+        except Exception as e:
+            print_error(f"Tor circuit {i+1:>{digits}}: failed: {e or type(e).__name__}")
+        finally:
+            await connector.close()
+
+    # circuits are built concurrently, one slow circuit does not hold up the rest
+    await asyncio.gather(*(test(i) for i in range(count)))
+
+
+def create_tor_session(
+    socks_port: int,
+    index: int,
+    timeout: aiohttp.ClientTimeout,
+    generation: int = 0,
+    limit: int = 100,
+    connector_kwargs: dict = None,
+    **session_kwargs,
+) -> aiohttp.ClientSession:
+    """
+    Return a session through circuit index, a new one for every generation
 
-async def create_tor_sessions(socks_port: int, count: int, timeout: int):
-    sessions = []
-    for i in range(count):
-        connector = ProxyConnector(
-            host="127.0.0.1",
-            port=socks_port,
-            proxy_type=ProxyType.SOCKS5,
-            rdns=True,
-            username=f"tor{i}",
-            password="password",
-        )
-        client_timeout = aiohttp.ClientTimeout(total=timeout)
-        sessions.append(
-            aiohttp.ClientSession(connector=connector, timeout=client_timeout)
-        )
-    return sessions
+    The SOCKS negotiation is part of the connect phase of timeout.
+    """
+    name = f"tor{index}" if not generation else f"tor{index}-{generation}"
+    connector = _circuit_connector(
+        socks_port, name, limit=limit, **(connector_kwargs or {})
+    )
+    return aiohttp.ClientSession(
+        connector=connector, timeout=timeout, **session_kwargs
+    )
@@ -1,7 +1,22 @@
+import asyncio
+import gzip
+import io
 import logging
+import lzma
+import os
+import sys
+import zlib
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Optional, TextIO
+
 import colorama
 from colorama import Fore, Style
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 colorama.init(autoreset=True)
 
 logger = logging.getLogger(__name__)
@@ -21,8 +36,23 @@ __all__ = [
     "print_info",
     "print_debug",
     "get_list_from_file",
+    "iter_lines",
+    "read_lines",
+    "count_lines",
+    "open_input",
+    "open_output",
+    "is_new",
 ]
 
+# raised by corrupt or truncated compressed inputs, besides OSError
+_DECOMPRESSION_ERRORS = (EOFError, zlib.error, lzma.LZMAError) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+# leading bytes of compressed inputs, and suffixes of compressed outputs
+_MAGIC = {b"\x1f\x8b": "gz", b"\xfd7zXZ\x00": "xz", b"\x28\xb5\x2f\xfd": "zst"}
+_SUFFIXES = {".gz": "gz", ".xz": "xz", ".zst": "zst"}
+
 
 def _print_message(level: int, prefix: str, color: str, message: str):
     logger.log(level, f"{color}{prefix} {message}{_RESET}")
@@ -60,3 +90,171 @@ def get_list_from_file(file_):
     with open(file_, "r") as f:
         list_ = [line.strip() for line in f]
     return list_
+
+
+def _zstandard():
+    if zstandard is None:
+        raise OSError("zstd needs the zstandard package (zstd extra)")
+    return zstandard
+
+
+def open_input(file_) -> BinaryIO:
+    """Open a file, or stdin for ``-``, to be read decompressed.
+
+    gzip, xz and zstd compression is recognized by the content, so that
+    it works for stdin and whatever the file name. Compressed inputs are
+    decompressed as they are read.
+
+    Args:
+        file_ (str): Input file name, or ``-``
+
+    Returns:
+        BinaryIO: Binary stream of the (decompressed) content
+    """
+    if str(file_) == "-":
+        # closing it leaves stdin open
+        raw = open(sys.stdin.fileno(), "rb", closefd=False)
+    else:
+        raw = open(file_, "rb")
+    try:
+        head = raw.peek(6)[:6]
+        kind = next((k for m, k in _MAGIC.items() if head.startswith(m)), None)
+        if kind == "gz":
+            return _Closing(gzip.GzipFile(fileobj=raw), raw)
+        if kind == "xz":
+            return _Closing(lzma.LZMAFile(raw), raw)
+        if kind == "zst":
+            return _zstandard().ZstdDecompressor().stream_reader(
+                raw, read_across_frames=True
+            )
+    except BaseException:
+        raw.close()
+        raise
+    return raw
+
+
+class _Closing(io.BufferedReader):
+    # a decompressing reader that also closes the file it reads from
+    def __init__(self, reader, raw):
+        super().__init__(reader)
+        self._raw_file = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._raw_file.close()
+
+
+def open_output(file_, newline: Optional[str] = None) -> TextIO:
+    """Open a file, or stdout for ``-``, to append text to.
+
+    The file is compressed when its name ends with .gz, .xz or .zst, as a
+    new gzip member, xz stream or zstd frame when it exists already, which
+    readers take as one. gzip and zstd output is readable up to the last
+    flush, xz output only once closed.
+
+    Args:
+        file_ (str): Output file name, or ``-``
+        newline (str): As for open
+
+    Returns:
+        TextIO: Text stream, closing the file when closed
+    """
+    if str(file_) == "-":
+        return open(
+            sys.stdout.fileno(), "w", encoding="utf-8", newline=newline, closefd=False
+        )
+    kind = _SUFFIXES.get(Path(file_).suffix.lower())
+    if kind == "gz":
+        return gzip.open(file_, "at", encoding="utf-8", newline=newline)
+    if kind == "xz":
+        return lzma.open(file_, "at", encoding="utf-8", newline=newline)
+    if kind == "zst":
+        writer = _zstandard().ZstdCompressor().stream_writer(open(file_, "ab"))
+        return io.TextIOWrapper(writer, encoding="utf-8", newline=newline)
+    return open(file_, "a", encoding="utf-8", newline=newline)
+
+
+def is_new(file_) -> bool:
+    """Tell whether output to a file starts it: missing, empty or stdout."""
+    if str(file_) == "-":
+        return True
+    try:
+        return os.path.getsize(file_) == 0
+    except FileNotFoundError:
+        return True
+
+
+def _lines(text: str):
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def iter_lines(file_):
+    """Lazily yield the non-empty lines of a file, or of stdin for ``-``.
+
+    Blank lines and lines starting with ``#`` are skipped. Compressed
+    files are decompressed, see open_input.
+
+    Args:
+        file_ (str): Input file name
+
+    Yields:
+        str: Stripped line
+    """
+    with io.TextIOWrapper(open_input(file_), encoding="utf-8", errors="replace") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+        except _DECOMPRESSION_ERRORS as e:
+            raise OSError(f"{file_}: {e}") from e
+
+
+async def read_lines(file_, size: int = 1 << 16) -> AsyncIterator[str]:
+    """Like iter_lines, reading in a thread.
+
+    Reading whatever is available, up to ``size`` bytes at a time, keeps
+    a slow input, such as a pipe from another tool, from holding up the
+    event loop, while the lines that did arrive are handed over at once.
+    """
+    f = await asyncio.to_thread(open_input, file_)
+    with f:
+        rest = b""
+        while chunk := await asyncio.to_thread(_read1, f, size, file_):
+            data = rest + chunk
+            end = data.rfind(b"\n") + 1
+            rest = data[end:]
+            for line in _lines(data[:end].decode(errors="replace")):
+                yield line
+        for line in _lines(rest.decode(errors="replace")):
+            yield line
+
+
+def _read1(f: BinaryIO, size: int, file_) -> bytes:
+    try:
+        return f.read1(size)
+    except _DECOMPRESSION_ERRORS as e:
+        raise OSError(f"{file_}: {e}") from e
+
+
+def count_lines(file_) -> int:
+    """Count the lines of a file, decompressed but without decoding it.
+
+    Args:
+        file_ (str): Input file name
+
+    Returns:
+        int: Number of lines, including blank and comment lines
+    """
+    count = 0
+    last = b"\n"
+    with open_input(file_) as f:
+        while chunk := _read1(f, 1 << 20, file_):
+            count += chunk.count(b"\n")
+            last = chunk[-1:]
+    return count + (last != b"\n")
@@ -0,0 +1,110 @@
+import asyncio
+from pathlib import Path
+from typing import IO, Any, List, Optional
+
+__all__ = ["BatchedWriter"]
+
+
+class BatchedWriter:
+    """Base of the append-only writers that buffer items and write batches.
+
+    Items are buffered and written in batches, either when ``batch_size``
+    items are pending or every ``interval`` seconds, so that the event
+    loop hands one write per batch to a thread instead of one per item.
+
+    Subclasses open the file in ``_open``, turn a batch into data with
+    ``_format`` and write it with ``_write``, in a thread. A failed write
+    stops the writer: it is passed to ``_failed``, raised by ``check``
+    and by ``close``.
+
+    A writer may ``follow`` others, whose items are then written before
+    each of its batches, e.g. so that the journal never records an
+    address the output file does not have yet.
+    """
+
+    def __init__(self, path: Path, interval: float = 1.0, batch_size: int = 1000):
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self._buffer: List[Any] = []
+        self._file: Optional[IO] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._closing = False
+        self._error: Optional[Exception] = None
+        self._followed: List["BatchedWriter"] = []
+
+    async def _open(self) -> IO:
+        raise NotImplementedError
+
+    def _format(self, batch: List[Any]) -> Any:
+        raise NotImplementedError
+
+    def _write(self, data: Any):
+        raise NotImplementedError
+
+    def _failed(self, error: Exception):
+        pass
+
+    async def open(self):
+        self._file = await self._open()
+        self._closing = False
+        self._task = asyncio.create_task(self._flusher())
+
+    def follow(self, writer: "BatchedWriter"):
+        """Write out what writer buffered before each batch of this writer."""
+        self._followed.append(writer)
+
+    def check(self):
+        """Raise the error of a failed write, if any."""
+        if self._error is not None:
+            raise self._error
+
+    def _append(self, item: Any):
+        self._buffer.append(item)
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer or self._file is None:
+                return
+            batch, self._buffer = self._buffer, []
+            # items added to the followed writers while they are flushed
+            # belong to a later batch of this one
+            for writer in self._followed:
+                await writer.flush()
+                writer.check()
+            await asyncio.to_thread(self._write, self._format(batch))
+
+    async def _flusher(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self._error = e
+                self._failed(e)
+                return
+
+    async def close(self):
+        if self._task is not None:
+            # let the flusher finish its current write instead of cancelling
+            # it in the middle of an fsync
+            self._closing = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        if self._file is not None:
+            try:
+                if self._error is None:
+                    await self.flush()
+            finally:
+                self._file.close()
+                self._file = None
+        self.check()